@@ -0,0 +1,217 @@
+import numpy as np
+
+from schema import INCOME_TERMS
+
+
+AMOUNTS = ['balance', 'bond', 'pending_rewards', 'pending_commission', 'net_tx']
+
+SECONDS_PER_DAY = 24 * 60 * 60
+SECONDS_PER_YEAR = 365.25 * SECONDS_PER_DAY
+
+
+class Snapshots:
+    """Snapshot columns of a set of accounts, held as arrays with the rows
+    of each account in one contiguous block, ordered by timestamp.
+
+    Amounts keep the type they were stored with: integer base units, or
+    scaled floats for databases in the old layout."""
+
+    def __init__(self, addresses, counts, timestamps, heights, amounts, ids):
+        self.addresses = addresses
+        self.counts = np.asarray(counts, dtype=np.int64)
+        self.ends = np.cumsum(self.counts)
+        self.starts = self.ends - self.counts
+        # the datetimes as read, for writing out; seconds for arithmetic
+        self.timestamps = timestamps
+        self.seconds = np.array(timestamps, dtype='datetime64[s]').astype(np.int64)
+        self.heights = heights
+        self.ids = ids
+        for name in AMOUNTS:
+            setattr(self, name, np.array(amounts[name]))
+
+        # the first row of each account has no income
+        self.first = np.zeros(len(timestamps), dtype=bool)
+        self.first[self.starts] = True
+
+    @classmethod
+    def from_rows(cls, rows):
+        """From rows ordered by account then timestamp, with an address,
+        timestamp, height, id and every one of AMOUNTS."""
+        addresses, counts = [], []
+        columns = {name: [] for name in ['timestamp', 'height', 'id'] + AMOUNTS}
+        for row in rows:
+            if len(addresses) == 0 or row['address'] != addresses[-1]:
+                addresses.append(row['address'])
+                counts.append(0)
+            counts[-1] += 1
+            for name, column in columns.items():
+                column.append(row[name])
+        return cls(
+            addresses,
+            counts,
+            columns['timestamp'],
+            columns['height'],
+            {name: columns[name] for name in AMOUNTS},
+            columns['id']
+        )
+
+    @classmethod
+    def batches(cls, rows, size=100000):
+        """Split a stream of rows into batches of about `size` rows; an
+        account is never split across batches."""
+        batch = []
+        for row in rows:
+            if len(batch) >= size and row['address'] != batch[-1]['address']:
+                yield cls.from_rows(batch)
+                batch = []
+            batch.append(row)
+        if len(batch) > 0:
+            yield cls.from_rows(batch)
+
+    def accounts(self):
+        """(address, rows) of every account, each row a dict of its columns
+        and income, which is None for the first row."""
+        income = self.income().tolist()
+        columns = {name: getattr(self, name).tolist() for name in AMOUNTS}
+        for (address, start, end) in zip(self.addresses, self.starts.tolist(), self.ends.tolist()):
+            yield address, [
+                dict(
+                    {name: column[i] for (name, column) in columns.items()},
+                    address=address,
+                    timestamp=self.timestamps[i],
+                    height=self.heights[i],
+                    id=self.ids[i],
+                    income=None if i == start else income[i]
+                )
+                for i in range(start, end)
+            ]
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __previous(self, values):
+        # the value of the row before, within each account
+        previous = np.roll(values, 1)
+        previous[self.first] = 0
+        return previous
+
+    def income(self):
+        """Income of every snapshot since the one before it, as defined by
+        schema.INCOME_TERMS; 0 for the first snapshot of each account, see
+        `first`."""
+        income = None
+        for name in INCOME_TERMS:
+            values = getattr(self, name)
+            # added up left to right, as in the SQL, so floats come out the same
+            income = values - self.__previous(values) if income is None else income + values - self.__previous(values)
+        income = income - self.net_tx
+        income[self.first] = 0
+        return income
+
+    def cumulative_income(self):
+        """Income of every account from its first snapshot up to each one."""
+        total = np.cumsum(self.income())
+        return total - np.repeat(total[self.starts], self.counts)
+
+    def stake(self):
+        """What earns income: the balance and bond."""
+        return self.balance + self.bond
+
+    def intervals(self):
+        """Seconds since the snapshot before, 0 for the first of each account."""
+        intervals = self.seconds - self.__previous(self.seconds)
+        intervals[self.first] = 0
+        return intervals
+
+    def period_yield(self):
+        """Income as a fraction of the stake at the snapshot before; NaN
+        where there is no stake to earn on."""
+        stake = self.__previous(self.stake()).astype(np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            result = self.income() / stake
+        result[(stake <= 0) | self.first] = np.nan
+        return result
+
+    def daily_yield(self):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.period_yield() * SECONDS_PER_DAY / self.intervals()
+
+    def annualized_yield(self):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.period_yield() * SECONDS_PER_YEAR / self.intervals()
+
+    def account_summaries(self):
+        """Per account: the number of snapshots, total income, the average
+        stake (weighted by time) and the annualized yield on it."""
+        income = np.add.reduceat(self.income(), self.starts) if len(self) > 0 else self.income()
+        intervals = self.intervals()
+        staked = self.__previous(self.stake()).astype(np.float64) * intervals
+        if len(self) > 0:
+            seconds = np.add.reduceat(intervals, self.starts)
+            staked = np.add.reduceat(staked, self.starts)
+        else:
+            seconds = staked = intervals
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            average_stake = np.where(seconds > 0, staked / seconds, np.nan)
+            annualized = np.where(staked > 0, income * SECONDS_PER_YEAR / staked, np.nan)
+
+        return [
+            {
+                'address': address,
+                'snapshots': int(count),
+                'income': income[i].item(),
+                'average_stake': average_stake[i].item(),
+                'annualized_yield': annualized[i].item()
+            }
+            for (i, (address, count)) in enumerate(zip(self.addresses, self.counts))
+        ]
+
+
+class NetworkAggregates:
+    """Income and yield across every account for each snapshot time,
+    gathered a batch of accounts at a time."""
+
+    def __init__(self):
+        self.__seconds = []
+        self.__income = []
+        self.__daily_yield = []
+
+    def add(self, snapshots):
+        income = snapshots.income()
+        self.__seconds.append(snapshots.seconds[~snapshots.first])
+        self.__income.append(income[~snapshots.first])
+        self.__daily_yield.append(snapshots.daily_yield()[~snapshots.first])
+
+    def by_snapshot(self):
+        """Per snapshot time: the number of accounts, their total income,
+        and the median daily yield of the accounts with a stake."""
+        if len(self.__seconds) == 0:
+            return []
+        seconds = np.concatenate(self.__seconds)
+        income = np.concatenate(self.__income)
+        daily_yield = np.concatenate(self.__daily_yield)
+
+        times, index, accounts = np.unique(seconds, return_inverse=True, return_counts=True)
+        total_income = np.zeros(len(times), dtype=income.dtype)
+        np.add.at(total_income, index, income)
+
+        # sorted by time then yield, a group's median is in its middle
+        valid = ~np.isnan(daily_yield)
+        order = np.lexsort((daily_yield[valid], index[valid]))
+        yields, groups = daily_yield[valid][order], index[valid][order]
+        counts = np.bincount(groups, minlength=len(times))
+        starts = np.cumsum(counts) - counts
+        low = yields[np.minimum(starts + (counts - 1) // 2, len(yields) - 1)] if len(yields) > 0 else np.zeros(len(times))
+        high = yields[np.minimum(starts + counts // 2, len(yields) - 1)] if len(yields) > 0 else np.zeros(len(times))
+        median = np.where(counts > 0, (low + high) / 2, np.nan)
+
+        return [
+            {
+                'timestamp': time.astype('datetime64[s]').item(),
+                'accounts': int(accounts[i]),
+                'income': total_income[i].item(),
+                'median_daily_yield': median[i].item()
+            }
+            for (i, time) in enumerate(times)
+        ]
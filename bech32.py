@@ -20,43 +20,58 @@
 
 """Reference implementation for Bech32 and segwit addresses."""
 """Adjusted by Ryan Funduk for Cosmos-like purposes on Feb 2, 2020"""
+"""Table-driven checksum and batch/memoized conversions added for
+reports over hundreds of thousands of accounts"""
+
+from functools import lru_cache
 
 __CHARSET = "qpzry9x8gf2tvdw0s3jn54khce6mua7l"
+__GENERATOR = [0x3b6a57b2, 0x26508e6d, 0x1ea119fa, 0x3d4233dd, 0x2a1462b3]
+
+# what the generator adds to the checksum for each value of its top 5 bits
+__TABLE = [0] * 32
+for __top in range(32):
+    for __i in range(5):
+        if (__top >> __i) & 1:
+            __TABLE[__top] ^= __GENERATOR[__i]
+del __top, __i
+
+__ENCODE = bytes.maketrans(bytes(range(32)), __CHARSET.encode('ascii'))
+__DECODE = {x: i for (i, x) in enumerate(__CHARSET)}
 
 
-def __bech32_polymod(values):
-    """Internal function that computes the Bech32 checksum."""
-    generator = [0x3b6a57b2, 0x26508e6d, 0x1ea119fa, 0x3d4233dd, 0x2a1462b3]
-    chk = 1
+def __bech32_polymod(values, chk=1):
+    """Internal function that computes the Bech32 checksum, carrying
+    on from `chk`."""
+    table = __TABLE
     for value in values:
-        top = chk >> 25
-        chk = (chk & 0x1ffffff) << 5 ^ value
-        for i in range(5):
-            chk ^= generator[i] if ((top >> i) & 1) else 0
+        chk = (chk & 0x1ffffff) << 5 ^ value ^ table[chk >> 25]
     return chk
 
 
-def __bech32_hrp_expand(hrp):
-    """Expand the HRP into values for checksum computation."""
-    return [ord(x) >> 5 for x in hrp] + [0] + [ord(x) & 31 for x in hrp]
+@lru_cache(maxsize=64)
+def __bech32_hrp_polymod(hrp):
+    """The checksum of the expanded HRP, which every address with it
+    starts from."""
+    return __bech32_polymod([ord(x) >> 5 for x in hrp] + [0] + [ord(x) & 31 for x in hrp])
 
 
 def __bech32_verify_checksum(hrp, data):
     """Verify a checksum given HRP and converted data characters."""
-    return __bech32_polymod(__bech32_hrp_expand(hrp) + data) == 1
+    return __bech32_polymod(data, __bech32_hrp_polymod(hrp)) == 1
 
 
 def __bech32_create_checksum(hrp, data):
     """Compute the checksum values given HRP and data."""
-    values = __bech32_hrp_expand(hrp) + data
-    polymod = __bech32_polymod(values + [0, 0, 0, 0, 0, 0]) ^ 1
-    return [(polymod >> 5 * (5 - i)) & 31 for i in range(6)]
+    polymod = __bech32_polymod(b'\0\0\0\0\0\0', __bech32_polymod(data, __bech32_hrp_polymod(hrp))) ^ 1
+    return bytes((polymod >> 5 * (5 - i)) & 31 for i in range(6))
 
 
 def encode(hrp, data):
     """Compute a Bech32 string given HRP and data values."""
+    data = bytes(data)
     combined = data + __bech32_create_checksum(hrp, data)
-    return hrp + '1' + ''.join([__CHARSET[d] for d in combined])
+    return hrp + '1' + combined.translate(__ENCODE).decode('ascii')
 
 
 def decode(bech):
@@ -68,10 +83,53 @@ def decode(bech):
     pos = bech.rfind('1')
     if pos < 1 or pos + 7 > len(bech) or len(bech) > 90:
         return (None, None)
-    if not all(x in __CHARSET for x in bech[pos+1:]):
+    data = [__DECODE.get(x) for x in bech[pos+1:]]
+    if None in data:
         return (None, None)
     hrp = bech[:pos]
-    data = [__CHARSET.find(x) for x in bech[pos+1:]]
     if not __bech32_verify_checksum(hrp, data):
         return (None, None)
     return (hrp, data[:-6])
+
+
+def encode_many(hrp, datas):
+    """Bech32 strings of many data values with the same HRP."""
+    return [encode(hrp, data) for data in datas]
+
+
+def decode_many(bechs):
+    """(HRP, data) of many Bech32 strings, (None, None) for invalid ones."""
+    return [decode(bech) for bech in bechs]
+
+
+def convertbits(data, frombits, tobits, pad=True):
+    """General power-of-2 base conversion, e.g. of 5-bit data values
+    to bytes; None if `data` doesn't fit."""
+    acc = 0
+    bits = 0
+    ret = bytearray()
+    maxv = (1 << tobits) - 1
+    max_acc = (1 << (frombits + tobits - 1)) - 1
+    for value in data:
+        if value < 0 or (value >> frombits):
+            return None
+        acc = ((acc << frombits) | value) & max_acc
+        bits += frombits
+        while bits >= tobits:
+            bits -= tobits
+            ret.append((acc >> bits) & maxv)
+    if pad:
+        if bits:
+            ret.append((acc << (tobits - bits)) & maxv)
+    elif bits >= frombits or ((acc << (tobits - bits)) & maxv):
+        return None
+    return bytes(ret)
+
+
+@lru_cache(maxsize=1 << 17)
+def convert(bech, hrp):
+    """The same address with another HRP, such as the cosmosvaloper
+    address of an account; None if `bech` is invalid. Recent conversions
+    are remembered."""
+    data = decode(bech)[1]
+    return encode(hrp, data) if data is not None else None
@@ -0,0 +1,156 @@
+import json
+import socket
+import signal
+import tempfile
+import subprocess
+
+from os import wait4, makedirs, WIFEXITED, WEXITSTATUS, WTERMSIG
+from sys import executable
+from time import monotonic
+from argparse import ArgumentParser
+from os.path import dirname, join, exists, getsize, splitext
+
+from report_on_snapshots import wait_ready
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def measure(command, log_path):
+    """Run `command` to completion, returning its wall time in seconds and
+    its peak resident set size in megabytes."""
+    with open(log_path, 'w') as output:
+        start = monotonic()
+        process = subprocess.Popen(command, stdout=output, stderr=subprocess.STDOUT)
+        (_, status, usage) = wait4(process.pid, 0)
+        seconds = monotonic() - start
+    process.returncode = WEXITSTATUS(status) if WIFEXITED(status) else -WTERMSIG(status)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command)
+    # ru_maxrss is in kilobytes on Linux
+    return seconds, usage.ru_maxrss / 1024
+
+
+def db_size(path):
+    return sum(getsize(f"{path}{suffix}") for suffix in ('', '-wal') if exists(f"{path}{suffix}"))
+
+
+class MockNode:
+    """mock_node.py in a subprocess, serving the RPC and LCD on one port."""
+
+    def __init__(self, args, accounts, log_path):
+        self.args = args
+        self.accounts = accounts
+        self.log_path = log_path
+        self.process = None
+
+    def start(self, height):
+        port = free_port()
+        self.process = subprocess.Popen(
+            [executable, '-u', join(dirname(__file__), 'mock_node.py'),
+             '--port', str(port),
+             '--accounts', str(self.accounts),
+             '--height', str(height),
+             '--latency', str(self.args.latency),
+             '--jitter', str(self.args.jitter),
+             '--error-rate', str(self.args.error_rate)] +
+            (['--replay', self.args.replay] if self.args.replay else []),
+            stdout=open(self.log_path, 'a'), stderr=subprocess.STDOUT
+        )
+        url = f"http://127.0.0.1:{port}"
+        wait_ready(f"{url}/status", self.args.ready_timeout)
+        return url
+
+    def stop(self):
+        if self.process is not None:
+            self.process.send_signal(signal.SIGINT)
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+            self.process = None
+
+
+def run_scenario(args, accounts):
+    """A first run on a new database, an incremental run a day later, then
+    the CSVs, against a synthetic chain of `accounts` accounts; yields the
+    results of each step as it completes."""
+    work_dir = tempfile.mkdtemp(prefix=f"{accounts}-", dir=args.work_dir)
+    db_path = join(work_dir, 'reports.db')
+    node = MockNode(args, accounts, join(work_dir, 'mock_node.log'))
+
+    def collect(step, height, incremental):
+        url = node.start(height)
+        try:
+            seconds, rss = measure(
+                [executable, '-u', join(dirname(__file__), 'calculate_earnings.py'),
+                 '--db-path', db_path,
+                 '--log-path', join(work_dir, 'error.log'),
+                 '--concurrency', str(args.concurrency),
+                 '--rpc', url,
+                 '--lcd', url] + (['--incremental'] if incremental else []),
+                join(work_dir, f"{step}.log")
+            )
+        finally:
+            node.stop()
+        with open(f"{splitext(db_path)[0]}-profile-{height}.json") as f:
+            profile = json.load(f)
+        requests = sum(stats['requests'] - stats['cached'] for stats in profile['endpoints'].values())
+        errors = sum(stats['errors'] for stats in profile['endpoints'].values())
+        return {
+            'accounts': accounts, 'step': step, 'seconds': round(seconds, 3), 'peak_rss_mb': round(rss, 1),
+            'requests': requests, 'requests_per_account': round(requests / accounts, 3), 'errors': errors,
+            'db_bytes': db_size(db_path)
+        }
+
+    yield collect('first run', args.height, False)
+    yield collect('incremental', args.height * 2, True)
+
+    seconds, rss = measure(
+        [executable, '-u', join(dirname(__file__), 'output_csvs.py'),
+         '--db-path', db_path,
+         '--output-dir', join(work_dir, 'csvs'),
+         '--summary', 'daily',
+         '--yields'],
+        join(work_dir, 'csvs.log')
+    )
+    yield {
+        'accounts': accounts, 'step': 'csvs', 'seconds': round(seconds, 3), 'peak_rss_mb': round(rss, 1),
+        'requests': 0, 'requests_per_account': 0, 'errors': 0, 'db_bytes': db_size(db_path)
+    }
+
+
+if __name__ == '__main__':
+    # parse command line arguments
+    parser = ArgumentParser(description="Time calculate_earnings.py and output_csvs.py against a synthetic chain served by mock_node.py")
+    parser.add_argument('--accounts', nargs='+', default=[1000, 10000, 100000], type=int, help="number of accounts of each scenario")
+    parser.add_argument('--height', default=14400, type=int, help="height of the first run; the incremental run is at twice it")
+    parser.add_argument('--concurrency', default=8, type=int, help="number of accounts to fetch from the LCD in parallel")
+    parser.add_argument('--latency', default=0, type=float, help="milliseconds the mock node waits before each response")
+    parser.add_argument('--jitter', default=0, type=float, help="milliseconds the latency varies by, either way")
+    parser.add_argument('--error-rate', default=0, type=float, help="fraction of account and transaction requests the mock node fails")
+    parser.add_argument('--replay', help="response cache database for the mock node to serve recorded responses from")
+    parser.add_argument('--work-dir', default=tempfile.gettempdir(), help="path to keep each scenario's databases, logs and CSVs in")
+    parser.add_argument('--ready-timeout', default=600, type=int, help="seconds to wait for the mock node to answer")
+    parser.add_argument('--output', help="path to write the results to, as JSON")
+    args = parser.parse_args()
+
+
+    makedirs(args.work_dir, exist_ok=True)
+
+    columns = ['accounts', 'step', 'seconds', 'peak_rss_mb', 'requests', 'requests_per_account', 'errors', 'db_bytes']
+    print(' '.join(f"{column:>20}" for column in columns))
+
+    results = []
+    for accounts in args.accounts:
+        for result in run_scenario(args, accounts):
+            print(' '.join(f"{result[column]:>20}" for column in columns), flush=True)
+            results.append(result)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,201 @@
+import re
+import json
+import calendar
+import datetime
+
+from sys import exit, byteorder
+from array import array
+from bisect import bisect_left
+from argparse import ArgumentParser
+from os import replace
+from os.path import exists
+from concurrent.futures import ThreadPoolExecutor
+
+from lcd_client import Client
+from genesis import JsonStream, open_genesis, read_document
+
+
+def parse_time(value):
+    """Milliseconds since the epoch of an RFC3339 block time, which
+    can carry anything up to nanoseconds."""
+    match = re.match(r'^(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(?:\.(\d+))?Z$', value)
+    if match is None:
+        raise ValueError(f"unexpected time {value!r}")
+    seconds = calendar.timegm(datetime.datetime.strptime(match.group(1), '%Y-%m-%dT%H:%M:%S').timetuple())
+    return seconds * 1000 + int((match.group(2) or '0')[:3].ljust(3, '0'))
+
+
+def format_time(ms):
+    time = datetime.datetime(1970, 1, 1) + datetime.timedelta(milliseconds=ms)
+    return time.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+
+class BlockTimes:
+    """Time of every block from `first_height` on, kept in a file as the
+    first height followed by one little-endian int64 (ms) per block."""
+
+    def __init__(self, path):
+        self.path = path
+        self.first_height = 1
+        self.times = array('q')
+
+        if exists(path):
+            with open(path, 'rb') as f:
+                header = array('q')
+                header.fromfile(f, 1)
+                self.times.frombytes(f.read())
+            if byteorder == 'big':
+                header.byteswap()
+                self.times.byteswap()
+            self.first_height = header[0]
+
+    def next_height(self):
+        return self.first_height + len(self.times)
+
+    def extend(self, headers):
+        """Add (height, ms) pairs, which must carry on from the last height."""
+        for height, ms in sorted(headers):
+            if len(self.times) == 0 and height != self.first_height:
+                self.first_height = height
+            if height != self.next_height():
+                raise ValueError(f"expected block {self.next_height()}, got {height}")
+            self.times.append(ms)
+
+    def save(self):
+        header = array('q', [self.first_height])
+        times = array('q', self.times)
+        if byteorder == 'big':
+            header.byteswap()
+            times.byteswap()
+        with open(f"{self.path}.tmp", 'wb') as f:
+            header.tofile(f)
+            times.tofile(f)
+        replace(f"{self.path}.tmp", self.path)
+
+    def time(self, height):
+        return self.times[height - self.first_height]
+
+    def halt_height(self, ms):
+        """The first block at or after `ms`, which is the height a node
+        polling for that time would have been stopped at."""
+        index = bisect_left(self.times, ms)
+        return self.first_height + index if index < len(self.times) else None
+
+
+def fetch_headers(rpc, start, end, concurrency):
+    """Yield batches of (height, ms) from the RPC's /blockchain, in order;
+    it returns at most 20 blocks per request."""
+    http = Client()
+
+    def fetch(min_height):
+        max_height = min(min_height + 19, end)
+        response = json.loads(http.get(f"{rpc}/blockchain?minHeight={min_height}&maxHeight={max_height}", cache=False))
+        return [
+            (int(meta['header']['height']), parse_time(meta['header']['time']))
+            for meta in response['result']['block_metas']
+        ]
+
+    window = max(concurrency, 1) * 20
+    with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as executor:
+        for window_start in range(start, end + 1, window):
+            batch = [header for headers in executor.map(fetch, range(window_start, min(window_start + window, end + 1), 20)) for header in headers]
+            yield batch
+
+
+def read_headers(path):
+    """(height, ms) from a dump with one JSON header per line; block metas
+    (with the header under `header`) are taken as well."""
+    with open(path, 'r') as f:
+        for line in f:
+            if not line.strip(): continue
+            header = json.loads(line)
+            header = header.get('header', header)
+            yield int(header['height']), parse_time(header['time'])
+
+
+FREQUENCY_UNITS = {
+    'second': datetime.timedelta(seconds=1),
+    'minute': datetime.timedelta(minutes=1),
+    'hour': datetime.timedelta(hours=1),
+    'day': datetime.timedelta(days=1),
+    'week': datetime.timedelta(weeks=1)
+}
+
+
+def parse_frequency(value):
+    """Milliseconds in a REPORT_FREQUENCY as given to `date -d`, such as "1 days"."""
+    match = re.match(r'^\s*(\d+)\s*(second|minute|hour|day|week)s?\s*$', value)
+    if match is None:
+        raise ValueError(f"unsupported frequency {value!r}")
+    return int(match.group(1)) * FREQUENCY_UNITS[match.group(2)] // datetime.timedelta(milliseconds=1)
+
+
+def halt_heights(block_times, genesis_ms, frequency_ms, final_height=None):
+    """(height, ms) of the block to snapshot at for every boundary, the
+    same ones generate-snapshots.bash would take while polling."""
+    boundary = genesis_ms + frequency_ms
+    last_height = None
+    while True:
+        height = block_times.halt_height(boundary)
+        if height is None or (final_height is not None and height >= final_height):
+            break
+        # a gap longer than the frequency only gets the one snapshot
+        if height != last_height:
+            yield height, block_times.time(height)
+        last_height = height
+        boundary += frequency_ms
+
+    if final_height is not None and final_height < block_times.next_height():
+        yield final_height, block_times.time(final_height)
+
+
+if __name__ == '__main__':
+    # parse command line arguments
+    parser = ArgumentParser(description="Index block times, and work out the height to snapshot at for each report period")
+    parser.add_argument('--index', required=True, help="path of the block time index, created or extended")
+    parser.add_argument('--rpc', help="RPC to read block headers from")
+    parser.add_argument('--headers', help="path to a dump of block headers (JSON lines) to read instead of the RPC")
+    parser.add_argument('--to-height', type=int, help="last height to index (defaults to the latest block of the RPC)")
+    parser.add_argument('--concurrency', default=8, type=int, help="number of requests to the RPC in parallel")
+    parser.add_argument('--genesis', help="path or URL of genesis.json, for the time periods start from")
+    parser.add_argument('--frequency', default="1 days", help="report frequency, as REPORT_FREQUENCY in generate-snapshots.bash")
+    parser.add_argument('--final-height', type=int, help="last block of the chain, which gets a final snapshot")
+    parser.add_argument('--output', help="path to write `height date` lines to for generate-snapshots.bash")
+    args = parser.parse_args()
+
+
+    block_times = BlockTimes(args.index)
+
+    if args.headers:
+        print(f"Indexing headers from {args.headers}... ")
+        block_times.extend(header for header in read_headers(args.headers) if header[0] >= block_times.next_height())
+        block_times.save()
+    elif args.rpc:
+        rpc = args.rpc.rstrip('/')
+        to_height = args.to_height or \
+                    int(json.loads(Client().get(f"{rpc}/status", cache=False))['result']['sync_info']['latest_block_height'])
+        print(f"Indexing headers {block_times.next_height()} to {to_height}... ")
+        for headers in fetch_headers(rpc, block_times.next_height(), to_height, args.concurrency):
+            block_times.extend(headers)
+            # keep what we have, so an interrupted run carries on
+            if block_times.next_height() % 10000 < len(headers):
+                block_times.save()
+        block_times.save()
+
+    if len(block_times.times) == 0:
+        print("No blocks indexed.")
+        exit(1)
+    print(f"Indexed blocks {block_times.first_height} to {block_times.next_height() - 1}")
+
+    if args.output:
+        if args.genesis:
+            with open_genesis(args.genesis) as f:
+                for kind, value in read_document(JsonStream(f), {('genesis_time',): 'genesis_time'}):
+                    genesis_ms = parse_time(value)
+        else:
+            genesis_ms = block_times.time(block_times.first_height)
+
+        with open(args.output, 'w') as f:
+            for height, ms in halt_heights(block_times, genesis_ms, parse_frequency(args.frequency), args.final_height):
+                f.write(f"{height} {format_time(ms)}\n")
+        print(f"Halt heights written to {args.output}")
@@ -3,23 +3,38 @@ import datetime
 import traceback
 import bech32
 import logging
+import zlib
+import cProfile
+import pstats
+import time
 
 from sqlite3 import connect, Row, PARSE_DECLTYPES, PARSE_COLNAMES
-from sys import exit
+from sys import exit, version_info
 from re import sub
-from argparse import ArgumentParser
+from argparse import ArgumentParser, ArgumentTypeError
 from functools import reduce
-from urllib.request import urlopen
+from decimal import Decimal
+from os.path import dirname, join, abspath, splitext
+from collections import deque
 from urllib.error import HTTPError
-from http.client import RemoteDisconnected
-from os.path import dirname, join
+from concurrent.futures import ThreadPoolExecutor
+from lcd_client import Client, ResponseCache, LoadController, CircuitBreaker, TRANSIENT_ERRORS
+from genesis import GenesisIndex, genesis_hash
+from state_export import StateExport
+from schema import ROLLUPS, INCOME_TERMS, init_schema, add_rollups
+from metrics import Metrics
+from transactions import Tx, TxCache, parse_timestamp, to_epoch, to_datetime
 
 
 class Db:
-    def __init__(self, path):
+    def __init__(self, path, scale):
         self.__conn = connect(path, detect_types=PARSE_DECLTYPES|PARSE_COLNAMES)
         self.__conn.row_factory = Row
-        self.__init_schema()
+        # writes are batched into one transaction per phase, and WAL lets
+        # readers (like output_csvs.py) carry on while a report is running
+        self.__conn.execute('PRAGMA journal_mode = WAL')
+        self.__conn.execute('PRAGMA synchronous = NORMAL')
+        init_schema(self.__conn, scale)
 
     def commit(self):
         self.__conn.commit()
@@ -40,98 +55,224 @@ class Db:
         return list(map(lambda row: row['address'], c.fetchall()))
 
     def add_account(self, address):
-        c = self.__conn.cursor()
-        c.execute('''
-            INSERT OR REPLACE INTO accounts (address)
+        self.add_accounts([address])
+
+    def add_accounts(self, addresses):
+        self.__conn.executemany('''
+            INSERT OR IGNORE INTO accounts (address)
             VALUES (?)
-        ''', (address,))
-        self.commit()
+        ''', map(lambda address: (address,), addresses))
 
-    def get_latest_report(self, address):
+    def get_valopers(self):
         c = self.__conn.cursor()
         r = c.execute('''
-            SELECT * FROM snapshots
+            SELECT address, valoper FROM accounts
+            WHERE valoper IS NOT NULL
+        ''')
+        return {row['address']: row['valoper'] for row in r}
+
+    def set_valopers(self, valopers):
+        self.__conn.executemany('''
+            UPDATE accounts SET valoper = ?
             WHERE address = ?
+        ''', [(valoper, address) for (address, valoper) in valopers.items()])
+
+    def get_latest_report(self, address):
+        c = self.__conn.cursor()
+        r = c.execute('''
+            SELECT accounts.address, account_snapshots.* FROM account_snapshots
+            JOIN accounts ON accounts.id = account_snapshots.account_id
+            WHERE accounts.address = ?
             ORDER BY timestamp DESC
             LIMIT 1
         ''', (address,))
         return r.fetchone()
 
-    def insert_report(self, address, timestamp, height, values):
-        self.__conn.execute('''
-            INSERT INTO snapshots(timestamp, height, address, balance, bond,
-                                  pending_rewards, pending_commission, net_tx)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
+    def get_latest_reports(self):
+        # sqlite takes the bare columns from the row holding the MAX()
+        c = self.__conn.cursor()
+        r = c.execute('''
+            SELECT accounts.address, account_snapshots.*, MAX(timestamp) FROM account_snapshots
+            JOIN accounts ON accounts.id = account_snapshots.account_id
+            GROUP BY account_id
+        ''')
+        return {row['address']: row for row in r}
+
+    def insert_report(self, address, timestamp, height, values, previous=None):
+        self.insert_reports([(address, timestamp, height, values)], previous)
+
+    def insert_reports(self, reports, previous=None):
+        """Insert reports and roll their income up into the income tables.
+
+        `previous` maps addresses to the values of their last report, and
+        is updated in place with the reports that were inserted."""
+        previous = {} if previous is None else previous
+        self.__conn.executemany('''
+            INSERT INTO account_snapshots(timestamp, height, account_id, balance, bond,
+                                          pending_rewards, pending_commission, net_tx)
+            VALUES (?, ?, (SELECT id FROM accounts WHERE address = ?), ?, ?, ?, ?, ?)
+        ''', [(
             timestamp,
-            height,
+            int(height),
             address,
             values['balance'],
             values['bond'],
             values['pending_rewards'],
             values['pending_commission'],
             values['net_tx']
-        ))
-
-    def __init_schema(self):
-        with self.__conn:
-            self.__conn.execute('''
-                CREATE TABLE IF NOT EXISTS snapshots (
-                    id INTEGER PRIMARY KEY,
-                    timestamp TIMESTAMP,
-                    height TEXT,
-                    address TEXT,
-                    balance REAL,
-                    bond REAL,
-                    pending_rewards REAL,
-                    pending_commission REAL,
-                    net_tx REAL
-                )
-            ''')
-            self.__conn.execute('''
-                CREATE TABLE IF NOT EXISTS accounts (
-                    address TEXT PRIMARY KEY
-                )
-            ''')
+        ) for (address, timestamp, height, values) in reports])
+
+        rollups = []
+        for (address, timestamp, height, values) in reports:
+            if previous.get(address) is not None:
+                amount = income(values, previous[address])
+                for (resolution, period_format) in ROLLUPS.items():
+                    rollups.append((address, resolution, timestamp.strftime(period_format), amount, 1))
+            previous[address] = values
+
+        add_rollups(self.__conn, rollups)
+
+    def insert_transactions(self, rows):
+        self.__conn.executemany('''
+            INSERT OR IGNORE INTO transactions(hash, msg_index, height, timestamp,
+                                               sender, recipient, amount, fee)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', rows)
 
+    def get_net_transaction_flow(self, address, since, until):
+        """What `address` received less what it sent and paid in fees;
+        unlike reports from before the index, the fees of sends it
+        received are not counted."""
+        c = self.__conn.cursor()
+        c.execute('''
+            SELECT
+                (SELECT COALESCE(SUM(amount), 0) FROM transactions
+                 WHERE recipient = :address AND timestamp > :since AND timestamp <= :until)
+                -
+                (SELECT COALESCE(SUM(amount + fee), 0) FROM transactions
+                 WHERE sender = :address AND timestamp > :since AND timestamp <= :until)
+        ''', {'address': address, 'since': since, 'until': until})
+        return c.fetchone()[0]
+
+    def insert_activity(self, rows):
+        self.__conn.executemany('''
+            INSERT OR IGNORE INTO activity(hash, msg_index, address, type, height, timestamp)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', rows)
+
+    def has_activity(self, address, since, until, unbonding_since, deposit_since):
+        """Whether anything could have changed the balance or bond of
+        `address` between two reports: a send or receive, any other indexed
+        message involving it, an unbonding that may have matured, a
+        proposal deposit that may have been refunded, or a message of an
+        account whose rewards it may be the withdraw address of."""
+        c = self.__conn.cursor()
+        c.execute('''
+            SELECT EXISTS (
+                SELECT 1 FROM transactions
+                WHERE sender = :address AND timestamp > :since AND timestamp <= :until
+            ) OR EXISTS (
+                SELECT 1 FROM transactions
+                WHERE recipient = :address AND timestamp > :since AND timestamp <= :until
+            ) OR EXISTS (
+                SELECT 1 FROM activity
+                WHERE address = :address AND timestamp > :since AND timestamp <= :until
+            ) OR EXISTS (
+                SELECT 1 FROM activity
+                WHERE address = :address AND type = 'cosmos-sdk/MsgUndelegate'
+                  AND timestamp > :unbonding_since AND timestamp <= :until
+            ) OR EXISTS (
+                SELECT 1 FROM activity
+                WHERE address = :address AND type IN ('cosmos-sdk/MsgDeposit', 'cosmos-sdk/MsgSubmitProposal')
+                  AND timestamp > :deposit_since AND timestamp <= :until
+            ) OR EXISTS (
+                -- rewards are paid to the withdraw address on withdrawals and
+                -- on any change to a delegation, so any message of an account
+                -- that ever set it as its withdraw address counts
+                SELECT 1 FROM activity target
+                JOIN activity setter ON setter.hash = target.hash AND setter.msg_index = target.msg_index
+                                    AND setter.address != target.address
+                JOIN activity delegator ON delegator.address = setter.address
+                WHERE target.address = :address AND target.type = 'cosmos-sdk/MsgSetWithdrawAddress'
+                  AND target.timestamp <= :until
+                  AND delegator.timestamp > :since AND delegator.timestamp <= :until
+            )
+        ''', {'address': address, 'since': since, 'until': until,
+              'unbonding_since': unbonding_since, 'deposit_since': deposit_since})
+        return c.fetchone()[0] == 1
 
-class Transaction:
-    def __init__(self, data):
-        self.__data = data
+    def start_run(self, chain, height, timestamp):
+        self.__conn.execute('''
+            INSERT OR IGNORE INTO runs (chain, height, timestamp)
+            VALUES (?, ?, ?)
+        ''', (chain, height, timestamp))
 
-    def amount(self):
-        if not self.__data['logs'][0]['success']:
-            return 0
-
-        def reducer(acc, msg):
-            # other message types can be ignored
-            if msg['type'] != 'cosmos-sdk/MsgSend':
-                return acc
-
-            value = msg['value']
-            amount = reduce(
-                lambda acc, amount: acc + float(amount['amount']),
-                filter(lambda amount: amount['denom'] == args.denom, value['amount']),
-                0
-            )
+    def set_failed_accounts(self, chain, height, addresses):
+        self.__conn.execute('''
+            DELETE FROM failed_accounts
+            WHERE chain = ? AND height = ?
+        ''', (chain, height))
+        self.__conn.executemany('''
+            INSERT INTO failed_accounts (chain, height, address)
+            VALUES (?, ?, ?)
+        ''', [(chain, height, address) for address in addresses])
+
+    def complete_run(self, chain, height):
+        self.__conn.execute('''
+            UPDATE runs SET completed_at = CURRENT_TIMESTAMP
+            WHERE chain = ? AND height = ?
+        ''', (chain, height))
 
-            return acc + (amount * (10 ** -args.scale))
+    def get_checkpoint(self, chain, name):
+        c = self.__conn.cursor()
+        c.execute('''
+            SELECT page, height FROM checkpoints
+            WHERE chain = ? AND name = ?
+        ''', (chain, name))
+        row = c.fetchone()
+        return (row['page'], row['height']) if row else (None, None)
 
-        return reduce(reducer, self.__data['tx']['value']['msg'], 0)
+    def set_checkpoint(self, chain, name, page, height):
+        self.__conn.execute('''
+            INSERT OR REPLACE INTO checkpoints (chain, name, page, height)
+            VALUES (?, ?, ?, ?)
+        ''', (chain, name, page, height))
 
-    def fees(self):
-        if not self.__data['logs'][0]['success']:
-            return 0
 
-        relevant_fee_amounts = list(filter(
-            lambda amount: amount['denom'] == args.denom,
-            self.__data['tx']['value']['fee']['amount'] or []
-        ))
+def income(values, previous):
+    # as defined by schema.INCOME_TERMS
+    return sum(values[name] - previous[name] for name in INCOME_TERMS) - values['net_tx']
 
-        if len(relevant_fee_amounts) > 0:
-            return float(relevant_fee_amounts[0]['amount']) * (10 ** -args.scale)
-        else:
-            return 0.0
+
+def account_addresses(value):
+    """Every account address found in a message, with validator
+    operator addresses turned into their account address."""
+    if isinstance(value, dict):
+        return set().union(*map(account_addresses, value.values()))
+    if isinstance(value, list):
+        return set().union(*map(account_addresses, value))
+    if isinstance(value, str):
+        if value.startswith('cosmosvaloper1'):
+            address = bech32.convert(value, 'cosmos')
+            return {address} if address is not None else set()
+        if value.startswith('cosmos1'):
+            return {value}
+    return set()
+
+
+class Transaction:
+    def __init__(self, data):
+        self.__data = data
+
+    def activity(self):
+        """Rows for the `activity` table, one per message and account. Failed
+        transactions are included, as their fees were still paid."""
+        timestamp = to_datetime(parse_timestamp(self.__data['timestamp']))
+        return [
+            (self.__data['txhash'], i, address, msg['type'], int(self.__data['height']), timestamp)
+            for (i, msg) in enumerate(self.__data['tx']['value']['msg'])
+            for address in account_addresses(msg['value'])
+        ]
 
 
 class Delegation:
@@ -139,18 +280,28 @@ class Delegation:
         self.__data = data
 
     def amount(self):
+        # shares are decimals, so the total is only truncated
+        # to base units once every delegation is added up
         try:
             amount = self.__data.get('shares') or \
-                     sum([float(entry['balance']) for entry in self.__data['entries']])
+                     sum([Decimal(entry['balance']) for entry in self.__data['entries']])
         except:
             amount = 0
 
-        return float(amount) * (10 ** -args.scale)
+        return Decimal(amount)
 
 
 class AccountProcessor:
-    def __init__(self, address):
+    def __init__(self, address, net_tx=None, operator=None, carried=None):
         self.address = address
+        # net transaction flow since the last report, when it
+        # is already known from the local transaction index
+        self.net_tx = net_tx
+        # validator operator address, only set for validators
+        self.operator = operator
+        # the last report, when nothing could have changed its
+        # balance or bond since
+        self.carried = carried
 
     def process_next(self, height, timestamp, prev_timestamp):
         if prev_timestamp is None:
@@ -159,61 +310,20 @@ class AccountProcessor:
             return self._get_next_state(prev_timestamp), timestamp, height
 
     def _get_genesis_state(self):
-        global genesis_cache
-        if genesis_cache is None:
-            response = urlopen(f"{RPC}/genesis").read()
-            genesis_cache = json.loads(response.decode('utf-8'))['result']['genesis']
-
-        genesis_time = sub('\.\d+Z$', "Z", genesis_cache['genesis_time'])
-        genesis_timestamp = datetime.datetime.strptime(genesis_time, "%Y-%m-%dT%H:%M:%SZ")
+        genesis_state = load_genesis_index().state(self.address)
+        print(f"\tGenesis baseline! Bal: {genesis_state['balance']}, Bond: {genesis_state['bond']}")
 
-        try:
-            balance_at_genesis = int(list(filter(
-                lambda account: account['address'] == self.address,
-                genesis_cache['app_state']['accounts']
-            ))[0]['coins'][0]['amount']) * (10 ** -args.scale)
-        except:
-            balance_at_genesis = 0
-
-        bonded_at_genesis = int(sum(map(lambda delegation: float(delegation['shares']), filter(
-            lambda delegation: delegation['delegator_address'] == self.address,
-            genesis_cache['app_state']['staking']['delegations'] or []
-        )))) * (10 ** -args.scale)
-
-        # special case: add any self bond at genesis
-        for gentx in (genesis_cache['app_state']['gentxs'] or []):
-            for msg in gentx['value']['msg']:
-                if msg['type'] != 'cosmos-sdk/MsgCreateValidator': continue
-                if msg['value']['delegator_address'] == self.address and msg['value']['value']['denom'] == args.denom:
-                    # the bond amount is also included in the genesis balance
-                    # so in the case of creating validators only, we need to substract
-                    # the bonded amount from balance ¯\_(ツ)_/¯
-                    amount = int(msg['value']['value']['amount']) * (10 ** -args.scale)
-                    bonded_at_genesis += amount
-                    balance_at_genesis -= amount
-
-        unbonding_at_genesis = int(sum(map(lambda delegation: sum(map(lambda entry: float(entry['balance']), delegation['entries'])), filter(
-            lambda delegation: delegation['delegator_address'] == self.address,
-            genesis_cache['app_state']['staking']['unbonding_delegations'] or []
-        )))) * (10 ** -args.scale)
-
-        print(f"\tGenesis baseline! Bal: {balance_at_genesis}, Bond: {bonded_at_genesis + unbonding_at_genesis}")
-        genesis_state = {
-            'balance': balance_at_genesis,
-            'bond': bonded_at_genesis + unbonding_at_genesis,
-            'pending_rewards': 0,
-            'pending_commission': 0,
-            'net_tx': 0
-        }
-
-        return genesis_state, genesis_timestamp, 0
+        return genesis_state, load_genesis_index().timestamp(), 0
 
     def _get_next_state(self, latest_report_time):
-        balance = self._get_current_balance()
-        bond = self._get_total_bond_balance()
+        if self.carried is not None:
+            balance, bond = self.carried['balance'], self.carried['bond']
+        else:
+            balance = self._get_current_balance()
+            bond = self._get_total_bond_balance()
         pending = self._get_current_pending_rewards()
         commission = self._get_current_pending_commission()
-        net = self._get_net_transaction_flow(latest_report_time)
+        net = self.net_tx if self.net_tx is not None else self._get_net_transaction_flow(latest_report_time)
 
         print(f"\tBal: {balance}, Bond: {bond}, PRew: {pending}, PCom: {commission}, NetTx: {net}")
         return {
@@ -225,101 +335,78 @@ class AccountProcessor:
         }
 
     def _get_current_balance(self):
-        try:
-            response = urlopen(f"{LCD}/bank/balances/{self.address}").read().decode('utf-8')
-            if len(response) == 0: return 0
-            data = json.loads(response)
-            if data is None: return 0
-            relevant_balances = list(filter(lambda bal: bal['denom'] == args.denom, data))
-            if len(relevant_balances) == 0: return 0
-        except:
-            logger.error(f"Could not retrieve balance for {self.address} at height {report_height}. Recorded `0`")
-            return 0
+        data = self._fetch_balance()
+        if data is None: return 0
+        relevant_balances = list(filter(lambda bal: bal['denom'] == args.denom, data))
+        if len(relevant_balances) == 0: return 0
 
         try:
-            amount = float(relevant_balances[0]['amount']) * (10 ** -args.scale)
+            amount = int(relevant_balances[0]['amount'])
         except IndexError:
             print(f"No relevant balances found for {self.address} (in {args.denom}). Did you specify the correct `denom`?")
             exit(1)
 
-        return round(amount, 3)
+        return amount
 
     def _get_current_pending_commission(self):
-        operator = bech32.encode('cosmosvaloper', bech32.decode(self.address)[1])
+        if self.operator is None: return 0
+
+        operator = self.operator
+        # the node answers with an error for accounts that aren't validators
+        # (which is most of them without the validator set) and for
+        # validators without a self-delegation; any other failure has the
+        # account tried again later
         try:
-            response = urlopen(f"{LCD}/distribution/validators/{operator}").read()
-            data = json.loads(response.decode('utf-8'))
-        except:
-            # if it failed, it's (likely/hopefully) just because this address
-            # is not a validator at all, so just set data to {} and move on
+            data = self._fetch_commission(operator, probe=True)
+        except HTTPError as e:
+            if not is_not_a_validator(e): raise
             data = {}
 
-        if data.get('val_commission') is None: return 0.0
+        if data.get('val_commission') is None: return 0
 
         relevant_commission = list(filter(lambda bal: bal['denom'] == args.denom, data['val_commission']))
 
         try:
-            amount = float(relevant_commission[0]['amount']) * (10 ** -args.scale)
+            # commission accrues in fractions of a base unit,
+            # only whole ones can be withdrawn
+            amount = int(Decimal(relevant_commission[0]['amount']))
         except IndexError:
             print(f"No relevant commission balances found for {operator} (in {args.denom}). Did you specify the correct `denom`?")
             exit(1)
 
-        return round(amount, 3)
+        return amount
 
     def _get_current_pending_rewards(self):
-        try:
-            response = urlopen(f"{LCD}/distribution/delegators/{self.address}/rewards").read()
-        except HTTPError as e:
-            # body = e.read().decode('utf-8')
-            # print(f"Explosion requesting rewards: {LCD}/distribution/delegators/{self.address}/rewards\n\n{body}\n\n\n\n")
-            # exit(1)
-            logger.error(f"Could not retrieve pending rewards for {self.address} at height {report_height}. Recorded `0`")
-            return 0
-
-        data = json.loads(response.decode('utf-8')) or [{ 'amount': 0, 'denom': args.denom }]
+        data = self._fetch_rewards() or [{ 'amount': 0, 'denom': args.denom }]
         relevant_balances = list(filter(lambda bal: bal['denom'] == args.denom, data))
 
         try:
-            amount = float(relevant_balances[0]['amount']) * (10 ** -args.scale)
+            amount = int(Decimal(relevant_balances[0]['amount']))
         except IndexError:
             print(f"No relevant reward balances found for {self.address} (in {args.denom}). Did you specify the correct `denom`?")
             exit(1)
 
-        return round(amount, 3)
+        return amount
 
     def _get_net_transaction_flow(self, cutoff):
-        try:
-            sends = urlopen(f"{LCD}/txs?action=send&sender={self.address}&limit=100").read()
-            receives = urlopen(f"{LCD}/txs?action=send&recipient={self.address}&limit=100").read()
-        except (HTTPError, RemoteDisconnected) as e:
-            logger.error(f"Could not retrieve net transaction flow for {self.address} at height {report_height}. Recorded `0`")
-            return 0
-
-        sends_data = json.loads(sends.decode('utf-8')) or []
-        receives_data = json.loads(receives.decode('utf-8')) or []
+        sends = http.get(f"{LCD}/txs?action=send&sender={self.address}&limit=100")
+        receives = http.get(f"{LCD}/txs?action=send&recipient={self.address}&limit=100")
 
-        sends_data = filter(lambda tx: datetime.datetime.strptime(tx['timestamp'], '%Y-%m-%dT%H:%M:%SZ') > cutoff, sends_data)
-        receives_data = filter(lambda tx: datetime.datetime.strptime(tx['timestamp'], '%Y-%m-%dT%H:%M:%SZ') > cutoff, receives_data)
+        sends_data = decode(sends) or []
+        receives_data = decode(receives) or []
 
-        sends_amount = reduce(
-            lambda acc, tx: acc + tx.amount() + tx.fees(),
-            map(lambda tx: Transaction(tx), sends_data),
-            0
-        )
-        receives_amount = reduce(
-            lambda acc, tx: acc + tx.amount() + tx.fees(),
-            map(lambda tx: Transaction(tx), receives_data),
-            0
-        )
+        # a send shows up in both the sender's and the recipient's search,
+        # so each tx is only parsed once however many accounts it touches
+        cutoff = to_epoch(cutoff)
+        sends_amount = sum(tx.amount + tx.fee for tx in map(tx_cache.parse, sends_data) if tx.time > cutoff)
+        # fees are paid by the sender only
+        receives_amount = sum(tx.amount for tx in map(tx_cache.parse, receives_data) if tx.time > cutoff)
 
-        return round(receives_amount - sends_amount, 3)
+        return receives_amount - sends_amount
 
     def _get_total_bond_balance(self):
-        bonded = urlopen(f"{LCD}/staking/delegators/{self.address}/delegations?limit=100").read()
-        unbonding = urlopen(f"{LCD}/staking/delegators/{self.address}/unbonding_delegations?limit=100").read()
-
-        bonded_data = json.loads(bonded.decode('utf-8')) or []
-        unbonding_data = json.loads(unbonding.decode('utf-8')) or []
+        bonded_data = self._fetch_delegations() or []
+        unbonding_data = self._fetch_unbonding_delegations() or []
 
         bonded_amount = reduce(
             lambda acc, bond: acc + bond.amount(),
@@ -332,7 +419,62 @@ class AccountProcessor:
             0
         ) if unbonding_data else 0
 
-        return round(bonded_amount + unbonding_amount, 3)
+        return int(bonded_amount + unbonding_amount)
+
+    def _fetch_balance(self):
+        response = http.get(f"{LCD}/bank/balances/{self.address}")
+        return decode(response) if len(response) > 0 else None
+
+    def _fetch_commission(self, operator, probe=False):
+        return decode(http.get(f"{LCD}/distribution/validators/{operator}", probe=probe))
+
+    def _fetch_rewards(self):
+        return decode(http.get(f"{LCD}/distribution/delegators/{self.address}/rewards"))
+
+    def _fetch_delegations(self):
+        return decode(http.get(f"{LCD}/staking/delegators/{self.address}/delegations?limit=100"))
+
+    def _fetch_unbonding_delegations(self):
+        return decode(http.get(f"{LCD}/staking/delegators/{self.address}/unbonding_delegations?limit=100"))
+
+
+class StateExportProcessor(AccountProcessor):
+    """Reports an account from an exported state instead of the LCD."""
+
+    def __init__(self, export, address, net_tx=None, operator=None, carried=None):
+        super().__init__(address, net_tx, operator, carried)
+        self.export = export
+
+    def _fetch_balance(self):
+        return self.export.balance(self.address)
+
+    def _fetch_commission(self, operator, probe=False):
+        return self.export.commission(operator)
+
+    def _fetch_rewards(self):
+        return self.export.rewards(self.address)
+
+    def _fetch_delegations(self):
+        return self.export.delegations.get(self.address)
+
+    def _fetch_unbonding_delegations(self):
+        return self.export.unbonding_delegations.get(self.address)
+
+
+def shard(value):
+    try:
+        index, count = map(int, value.split('/'))
+    except ValueError:
+        raise ArgumentTypeError(f"expected i/n, got {value!r}")
+    if not 0 <= index < count:
+        raise ArgumentTypeError(f"shard index must be from 0 to {count - 1}")
+    return index, count
+
+
+def in_shard(address, shard):
+    # crc32 rather than hash(), which is salted per process
+    index, count = shard
+    return zlib.crc32(address.encode('utf-8')) % count == index
 
 
 # parse command line arguments
@@ -340,21 +482,106 @@ parser = ArgumentParser(description="Report on an account's earnings")
 parser.add_argument('--db-path', required=True, help="path to store sqlite3 database with reports")
 parser.add_argument('--log-path', default=join(dirname(__file__), 'error.log'), help="path to error log")
 parser.add_argument('--denom', nargs='?', default='uatom', help="the denomination of balances/shares/etc")
-parser.add_argument('--scale', nargs='?', default=6, type=int, help="scale factor to real world denom from chain denom")
+parser.add_argument('--scale', nargs='?', default=6, type=int, help="scale factor to real world denom from chain denom, for converting databases from before amounts were kept in base units")
+parser.add_argument('--genesis', help="path to a local genesis.json to use instead of requesting it from the RPC")
+parser.add_argument('--no-tx-index', action='store_true', help="query each account's sends/receives from the LCD instead of indexing them locally")
+parser.add_argument('--no-cache', action='store_true', help="don't keep LCD/RPC responses on disk for resuming a run at the same height")
+parser.add_argument('--keep-cache', action='store_true', help="keep the LCD/RPC responses of a completed run, e.g. as fixtures for mock_node.py --replay")
+parser.add_argument('--tx-cache-size', default=100000, type=int, help="number of parsed transactions to keep in memory for working out net transaction flow without the local index")
+parser.add_argument('--concurrency', default=1, type=int, help="number of accounts to fetch from the LCD in parallel")
+parser.add_argument('--retries', default=3, type=int, help="number of times to try a request again after a transient failure")
+parser.add_argument('--latency-target', default=2.0, type=float, help="seconds an LCD request may take before fewer are sent at once")
+parser.add_argument('--requeue-passes', default=2, type=int, help="number of times to try accounts that failed again, at the end of the run, before recording them as failed")
+parser.add_argument('--state-export', help="path to an exported state (`gaiad export`) to report every account from, instead of the LCD")
+parser.add_argument('--export-height', help="block height of the exported state")
+parser.add_argument('--export-time', help="block time of the exported state, e.g. 2019-12-11T16:00:00Z")
+parser.add_argument('--incremental', action='store_true', help="carry balance and bond forward for accounts without any indexed activity since their last report; "
+                         "approximate, as balance changes that no message of the account shows (such as a community pool spend to it) are missed")
+parser.add_argument('--shard', type=shard, help="only report on slice i of n (0-based) of the accounts, e.g. 0/4; merge the shard databases with merge_shards.py")
+parser.add_argument('--rpc', default='http://localhost:26657', help="RPC to use, such as a replica of the same snapshot")
+parser.add_argument('--lcd', default='http://localhost:1317', help="LCD to use, such as a replica of the same snapshot")
+parser.add_argument('--profile', action='store_true', help="run the account collection under cProfile, writing its stats next to the run profile")
 args = parser.parse_args()
 
+if args.incremental and args.no_tx_index:
+    parser.error("--incremental needs the local transaction index")
+if args.state_export and (args.export_height is None or args.export_time is None):
+    parser.error("--state-export requires --export-height and --export-time")
+
+
+RPC = args.rpc.rstrip('/')
+LCD = args.lcd.rstrip('/')
+
+# counts and timings of the run, written out as its profile at the end
+metrics = Metrics()
+
+# keep-alive connections shared by all the workers, with only as many
+# requests in flight as the node keeps up with
+http = Client(
+    metrics=metrics,
+    retries=args.retries,
+    controller=LoadController(max(args.concurrency, 1), args.latency_target),
+    breaker=CircuitBreaker()
+)
+
+# parsed sends, shared by all the workers
+tx_cache = TxCache(args.denom, args.tx_cache_size)
 
-RPC = 'http://localhost:26657'
-LCD = 'http://localhost:1317'
 
-rpc_status = json.loads(urlopen(f"{RPC}/status").read())
-report_height = rpc_status['result']['sync_info']['latest_block_height']
-chain = rpc_status['result']['node_info']['network']
+def decode(body):
+    with metrics.phase('json_decode'):
+        return json.loads(body.decode('utf-8'))
+
+
+def is_not_a_validator(error):
+    """Whether the node's error response to a commission lookup says
+    there is no such validator, rather than that it failed."""
+    if error.code in (400, 404):
+        return True
+    # legacy LCDs answer with a 500 either way, and say which in the body
+    message = error.read().decode('utf-8', 'replace').lower()
+    return any(reason in message for reason in ('does not exist', 'not found', 'no validator', 'no delegation'))
+
+
+if args.state_export:
+    # everything comes from one pass over the export; the
+    # nodes are not needed at all
+    print("Reading state export... ")
+    state_export = StateExport(args.state_export, args.denom)
+    report_height = args.export_height
+    chain = state_export.chain_id
+    block_time = args.export_time
+else:
+    state_export = None
+    rpc_status = decode(http.get(f"{RPC}/status"))
+    report_height = rpc_status['result']['sync_info']['latest_block_height']
+    chain = rpc_status['result']['node_info']['network']
+    block_time = rpc_status['result']['sync_info']['latest_block_time']
+
+latest_block_time = datetime.datetime.strptime(sub('\.\d+Z$', "Z", block_time), '%Y-%m-%dT%H:%M:%SZ')
 
 print(f"Running report at block {report_height}...")
 
 
-db = Db(args.db_path)
+db = Db(args.db_path, args.scale)
+
+# an export has no transactions, so its net transaction flow comes from
+# the sends indexed by earlier runs, which have to reach its height
+if state_export is not None:
+    _, indexed_height = db.get_checkpoint(chain, 'send')
+    if (indexed_height or 0) < int(report_height):
+        print(f"Send transactions are only indexed up to height {indexed_height or 0}, so the net transaction flow "
+              f"up to {report_height} can't be worked out. Run against a node at or past that height first")
+        exit(1)
+
+db.start_run(chain, report_height, latest_block_time)
+db.commit()
+
+
+# if this run is interrupted, a rerun at the same height
+# is served from the responses we already have
+if not args.no_cache and state_export is None:
+    http.cache = ResponseCache(join(dirname(abspath(args.db_path)), f"{chain}-http-cache.db"), chain, report_height)
 
 
 logging.basicConfig(filename=args.log_path, format='%(message)s', filemode='a')
@@ -362,88 +589,388 @@ logger = logging.getLogger()
 
 
 # check that we can access LCD
-lcd_status = urlopen(f"{LCD}/node_info").read()
+if state_export is None:
+    lcd_status = http.get(f"{LCD}/node_info", cache=False)
+
+
+# dont want to request or parse genesis more than once per chain,
+# so keep an index of it next to the database
+genesis_index = None
 
 
-# dont want to request genesis more than once
-genesis_cache = None
+def load_genesis_index():
+    global genesis_index
+    if genesis_index is None:
+        path = GenesisIndex.path_for(args.db_path, chain)
+        with metrics.phase('genesis'):
+            genesis_index = GenesisIndex.load(path, chain, args.denom, genesis_hash(args.genesis) if args.genesis else None)
+            if genesis_index is None and state_export is not None and not args.genesis:
+                print(f"No genesis index for {chain} next to the database. With --state-export there is no node to request genesis from, so give --genesis")
+                exit(1)
+            if genesis_index is None:
+                print("Indexing genesis... ")
+                genesis_index = GenesisIndex.build(args.genesis or f"{RPC}/genesis", args.denom)
+                genesis_index.save(path)
+    return genesis_index
 
 
 # ensure genesis accounts exist
 if db.is_empty():
     print("Ensure genesis accounts... ")
-    response = urlopen(f"{RPC}/genesis").read()
-    genesis_cache = json.loads(response.decode('utf-8'))['result']['genesis']
+    db.add_accounts(map(lambda gentx: gentx[0], load_genesis_index().gentxs))
+    db.commit()
 
-    for gentx in (genesis_cache['app_state']['gentxs'] or []):
-        for msg in gentx['value']['msg']:
-            if msg['type'] == 'cosmos-sdk/MsgCreateValidator':
-                db.add_account(msg['value']['delegator_address'])
 
+def fetch_pages(action, name):
+    """Yield pages of `action` transactions from the last checkpoint onward,
+    requesting a window of pages at a time."""
 
-# get all delegation transactions and ensure we have accounts saved
+    # on hub1/hub2 there is no indication of the number of pages, so
+    # we have to just keep getting pages until the highest height in
+    # a page is the highest height we already have in this run
+    page, _ = db.get_checkpoint(chain, name)
+    tx_hwm = 0
 
-# on hub1/hub2 there is no indication of the number of pages, so
-# we have to just keep getting pages until the highest height in
-# a page is the highest height we already have
-tx_hwm = 0
+    # start from the highest page retrieved last time (less one to be safe)
+    page = max((page or 1) - 1, 1)
 
-# if we try to get all delegation transactions each day, the
-# process will quickly reach 500+ pages of requests for every report day
-# so store the highest page we've retrieved and start there (less one to be safe)
-# on the next run through
-try:
-    page = int(open(f".detect-delegators-page-num-{chain}",'r').read()) - 1
-except:
-    page = 1
-
-print("Adding new delegator accounts... ")
-while True:
-    txs_response = urlopen(f"{LCD}/txs?action=delegate&limit=100&page={page}").read()
-    txs = json.loads(txs_response.decode('utf-8'))
-
-    highest_tx = max(map(lambda tx: int(tx['height']), txs))
-    if highest_tx <= tx_hwm: break
-    tx_hwm = highest_tx
-
-    for tx in txs:
-        for msg in tx['tx']['value']['msg']:
-            try:
-                address = msg['value']['delegator_address']
-                db.add_account(address)
-            except:
-                # a message without a delegator_address means it was
-                # a different type, such as a withdraw rewards etc,
-                # included in the same transaction
-                pass
-
-    page += 1
-    open(f".detect-delegators-page-num-{chain}", 'w').write(str(page))
+    def fetch(page):
+        response = http.get(f"{LCD}/txs?action={action}&limit=100&page={page}")
+        return decode(response) or []
 
+    window = max(args.concurrency, 1)
+    with ThreadPoolExecutor(max_workers=window) as executor:
+        while True:
+            for txs in list(executor.map(fetch, range(page, page + window))):
+                if len(txs) == 0: return
 
-all_accounts = db.get_accounts()
-print(f"Total accounts: {len(all_accounts)}")
+                highest_tx = max(map(lambda tx: int(tx['height']), txs))
+                if highest_tx <= tx_hwm: return
+                tx_hwm = highest_tx
 
+                yield txs
 
-latest_block_time = datetime.datetime.strptime(
-    sub('\.\d+Z$', "Z", rpc_status['result']['sync_info']['latest_block_time']),
-    '%Y-%m-%dT%H:%M:%SZ'
-)
+                # the checkpoint is committed along with whatever
+                # was written for the page
+                page += 1
+                db.set_checkpoint(chain, name, page, tx_hwm)
+                db.commit()
 
-for address in all_accounts:
-    print(f"Generating report for {address} at {latest_block_time}...")
 
-    latest_report_time = dict(db.get_latest_report(address) or {}).get('timestamp', None)
-    ap = AccountProcessor(address)
+# get all delegation transactions and ensure we have accounts saved
 
-    report, timestamp, height = ap.process_next(report_height, latest_block_time, latest_report_time)
-    db.insert_report(address, timestamp, height, report)
+# pick up where the old page number dotfile left off
+if db.get_checkpoint(chain, 'delegate')[0] is None:
+    try:
+        db.set_checkpoint(chain, 'delegate', int(open(f".detect-delegators-page-num-{chain}",'r').read()), 0)
+        db.commit()
+    except:
+        pass
+
+with metrics.phase('discovery'):
+    print("Adding new delegator accounts... ")
+    if state_export is not None:
+        db.add_accounts(state_export.delegators())
+        db.commit()
+    else:
+        for txs in fetch_pages('delegate', 'delegate'):
+            addresses = []
+            for tx in txs:
+                for msg in tx['tx']['value']['msg']:
+                    try:
+                        addresses.append(msg['value']['delegator_address'])
+                    except:
+                        # a message without a delegator_address means it was
+                        # a different type, such as a withdraw rewards etc,
+                        # included in the same transaction
+                        pass
+            # only valid account addresses are reported on
+            valid = [
+                address for (address, (hrp, _)) in zip(addresses, bech32.decode_many(addresses))
+                if hrp == 'cosmos' and address.islower()
+            ]
+            for address in set(addresses) - set(valid):
+                logger.error(f"Skipped invalid delegator address {address!r} at height {report_height}")
+            db.add_accounts(valid)
+            db.insert_activity([row for tx in txs for row in Transaction(tx).activity()])
+
+
+# index all send transactions locally, so net transaction flow is a
+# range query instead of two LCD searches per account
+with metrics.phase('discovery'):
+    if not args.no_tx_index and state_export is None:
+        print("Indexing send transactions... ")
+        for txs in fetch_pages('send', 'send'):
+            db.insert_transactions([row for tx in txs for row in Tx(tx, args.denom).rows()])
+        # every send up to this height is in the index now, which a later
+        # --state-export run at or below it relies on
+        page, height = db.get_checkpoint(chain, 'send')
+        db.set_checkpoint(chain, 'send', page or 1, max(height or 0, int(report_height)))
+        db.commit()
+
+
+# other messages that move funds or bonds without a send, for
+# telling which accounts have been inactive since their last report
+ACTIVITY_ACTIONS = [
+    'begin_unbonding', 'begin_redelegate', 'withdraw_delegator_reward',
+    'withdraw_validator_commission', 'set_withdraw_address', 'multisend',
+    'create_validator', 'edit_validator', 'unjail',
+    'submit_proposal', 'deposit', 'vote'
+]
+
+incremental = args.incremental and state_export is None
+with metrics.phase('discovery'):
+    if incremental:
+        print("Indexing account activity... ")
+        for action in ACTIVITY_ACTIONS:
+            for txs in fetch_pages(action, action):
+                db.insert_activity([row for tx in txs for row in Transaction(tx).activity()])
 
-    # run again if we just did genesis
-    if latest_report_time is None:
-        report, timestamp, height = ap.process_next(report_height, latest_block_time, timestamp)
-        db.insert_report(address, timestamp, height, report)
 
-    db.commit()
+all_accounts = db.get_accounts()
+print(f"Total accounts: {len(all_accounts)}")
+
+if args.shard is not None:
+    all_accounts = [address for address in all_accounts if in_shard(address, args.shard)]
+    print(f"Accounts in shard {args.shard[0]}/{args.shard[1]}: {len(all_accounts)}")
+
+
+latest_reports = db.get_latest_reports()
+previous_reports = dict(latest_reports)
+latest_report_times = {
+    address: latest_reports[address]['timestamp'] if address in latest_reports else None
+    for address in all_accounts
+}
+
+# write the genesis baseline for every new account in one pass
+new_accounts = [address for address in all_accounts if latest_report_times[address] is None]
+if len(new_accounts) > 0:
+    print(f"Generating genesis baseline for {len(new_accounts)} new accounts...")
+    genesis_reports = []
+    with metrics.phase('genesis'):
+        for address in new_accounts:
+            report, timestamp, height = AccountProcessor(address).process_next(report_height, latest_block_time, None)
+            genesis_reports.append((address, timestamp, height, report))
+            latest_report_times[address] = timestamp
+    with metrics.phase('writes'):
+        db.insert_reports(genesis_reports, previous_reports)
+        db.commit()
+    metrics.count('genesis_baselines', len(new_accounts))
+
+
+# only validators have commission to look up, so figure out which
+# accounts are operators from the validator set and genesis gentxs
+def load_validators():
+    validators = set(map(lambda gentx: gentx[1], load_genesis_index().gentxs))
+
+    for status in ('bonded', 'unbonding', 'unbonded'):
+        page, seen = 1, set()
+        while True:
+            response = http.get(f"{LCD}/staking/validators?status={status}&page={page}&limit=100")
+            operators = list(map(lambda validator: validator['operator_address'], decode(response) or []))
+
+            # older LCDs ignore paging and return every validator on every page
+            if len(operators) == 0 or operators[0] in seen: break
+            seen.update(operators)
+            if len(operators) < 100: break
+            page += 1
+
+        validators.update(seen)
+
+    return validators
+
+
+print("Loading validator set... ")
+try:
+    with metrics.phase('validators'):
+        validators = set(state_export.validators) if state_export is not None else load_validators()
+    print(f"Validators: {len(validators)}")
+except TRANSIENT_ERRORS + (ValueError, KeyError):
+    # without the validator set, look for commission on every account
+    logger.error(f"Could not retrieve validator set at height {report_height}. Checking commission for all accounts")
+    metrics.fallback('validator_set')
+    validators = None
+
+# the operator address of each account is stored, so
+# it is only derived once
+valopers = db.get_valopers()
+missing_valopers = {
+    address: bech32.convert(address, 'cosmosvaloper')
+    for address in all_accounts if address not in valopers
+}
+db.set_valopers(missing_valopers)
+db.commit()
+valopers.update(missing_valopers)
+
+
+def collect(address, latest_report_time, net_tx, carried):
+    print(f"Generating report for {address} at {latest_block_time}...")
+    operator = valopers[address] if validators is None or valopers[address] in validators else None
+    if state_export is not None:
+        ap = StateExportProcessor(state_export, address, net_tx, operator)
+    else:
+        ap = AccountProcessor(address, net_tx, operator, carried)
+    return ap.process_next(report_height, latest_block_time, latest_report_time)
+
+
+# reports waiting to be written in the next batch
+reports = []
+
+# an account that couldn't be retrieved is tried again at the end
+# of the run, rather than recorded with zeroes
+ACCOUNT_ERRORS = TRANSIENT_ERRORS + (json.JSONDecodeError,)
+
+
+def write(address, carried, future, failed):
+    # the main thread is the only one touching the database
+    global carried_forward
+    try:
+        report, timestamp, height = future.result()
+    except ACCOUNT_ERRORS as e:
+        logger.error(f"Could not retrieve {address} at height {report_height} ({e!r}). Requeued")
+        failed.append(address)
+        return
+    reports.append((address, timestamp, height, report))
+    metrics.count('accounts')
+    if carried:
+        carried_forward += 1
+
+    if len(reports) >= 500:
+        flush()
+
+
+def flush():
+    with metrics.phase('writes'):
+        db.insert_reports(reports, previous_reports)
+        db.commit()
+    reports.clear()
+
+
+# accounts that already have a report at this height were
+# completed by an earlier, interrupted run
+pending_accounts = [
+    address for address in all_accounts
+    if address not in latest_reports or str(latest_reports[address]['height']) != str(report_height)
+]
+if len(pending_accounts) < len(all_accounts):
+    print(f"Resuming, {len(all_accounts) - len(pending_accounts)} accounts already done")
+
+unbonding_period = load_genesis_index().unbonding_period() if incremental else None
+deposit_refund_period = load_genesis_index().deposit_refund_period() if incremental else None
+carried_forward = 0
+
+# with --profile, the collection is run under cProfile; before
+# Python 3.12 it only sees the thread it is enabled in, so each
+# worker gets its own
+profiles = []
+
+
+def start_profile():
+    profile = cProfile.Profile()
+    profiles.append(profile)
+    profile.enable()
+
+
+if args.profile:
+    start_profile()
+
+
+def collect_all(addresses):
+    """Report on `addresses`, returning the ones that couldn't be retrieved.
+
+    A bounded number of accounts are kept in flight, and written out in
+    the order they were submitted."""
+    failed = []
+    with ThreadPoolExecutor(max_workers=args.concurrency,
+                            initializer=start_profile if args.profile and version_info < (3, 12) else None) as executor:
+        in_flight = deque()
+        for address in addresses:
+            latest_report_time = latest_report_times[address]
+            # an export has no transactions, so net flow always comes
+            # from what was indexed by earlier runs (checked above)
+            net_tx = None if args.no_tx_index and state_export is None else \
+                     db.get_net_transaction_flow(address, latest_report_time, latest_block_time)
+            # only pending rewards and commission need asking for when the
+            # account has done nothing since a report after genesis
+            carried = None
+            if incremental and net_tx == 0 and address in latest_reports and \
+               str(latest_reports[address]['height']) != '0' and \
+               not db.has_activity(address, latest_report_time, latest_block_time,
+                                   latest_report_time - unbonding_period, latest_report_time - deposit_refund_period):
+                carried = latest_reports[address]
+            in_flight.append((address, carried is not None, executor.submit(collect, address, latest_report_time, net_tx, carried)))
+
+            if len(in_flight) >= args.concurrency * 4:
+                write(*in_flight.popleft(), failed)
+
+        while in_flight:
+            write(*in_flight.popleft(), failed)
+
+        flush()
+    return failed
+
+
+with metrics.phase('collection'):
+    failed = collect_all(pending_accounts)
+    for _ in range(args.requeue_passes):
+        if len(failed) == 0: break
+        # give failing endpoints time to recover first
+        time.sleep(http.breaker.remaining())
+        print(f"Requeueing {len(failed)} failed accounts...")
+        metrics.count('requeued', len(failed))
+        failed = collect_all(failed)
+
+if incremental:
+    print(f"Carried forward balance and bond for {carried_forward} inactive accounts")
+metrics.count('carried_forward', carried_forward)
+metrics.count('resumed', len(all_accounts) - len(pending_accounts))
+metrics.count('tx_cache_hits', tx_cache.hits)
+metrics.count('tx_cache_misses', tx_cache.misses)
+
+# accounts still failing after every pass are recorded as such, rather
+# than keeping the run (and every snapshot after it) from completing; a
+# rerun at the same height tries just them again, from the response cache
+db.set_failed_accounts(chain, report_height, failed)
+db.complete_run(chain, report_height)
+db.commit()
+if len(failed) > 0:
+    print(f"Could not retrieve {len(failed)} accounts, they have no report at this height (see failed_accounts). Rerun at the same height to try them again")
+    for address in failed:
+        logger.error(f"Could not retrieve {address} at height {report_height}. Recorded as failed")
+    metrics.count('failed', len(failed))
+elif http.cache is not None and not args.keep_cache:
+    http.cache.clear()
+
+# the run profile, and the cProfile stats, go next to the database
+profile_path = f"{splitext(args.db_path)[0]}-profile-{report_height}"
+hot_path = None
+if args.profile:
+    for profile in profiles:
+        profile.disable()
+    stats = pstats.Stats(*profiles)
+    stats.dump_stats(f"{profile_path}.prof")
+    hot_path = [
+        {
+            'function': f"{file}:{line}({name})",
+            'calls': calls,
+            'seconds': round(own, 3),
+            'cumulative_seconds': round(cumulative, 3)
+        }
+        for ((file, line, name), (primitive, calls, own, cumulative, callers))
+        in sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)[:25]
+    ]
+    print(f"cProfile stats: {profile_path}.prof")
+
+metrics.save(
+    f"{profile_path}.json",
+    chain=chain,
+    height=report_height,
+    block_time=latest_block_time,
+    accounts=len(all_accounts),
+    concurrency=args.concurrency,
+    concurrency_limit=round(http.controller.limit, 1),
+    hot_path=hot_path
+)
+print(f"Run profile: {profile_path}.json")
 
 print("DONE")
@@ -9,8 +9,13 @@ NODE_BINARY=${NODE_BINARY:-gaiad}
 # how to access the RPC
 RPC_URL=${RPC_URL:-"localhost:26657"}
 
+# optional `height time` lines from block_times.py; with them the node is
+# run to each height with --halt-height and snapshotted there, instead of
+# polling the RPC for the block time
+HALT_HEIGHTS=${HALT_HEIGHTS:-}
+
 # FINAL_BLOCK is needed so we know when the chain stopped
-if [ -z $FINAL_BLOCK ]; then
+if [ -z $FINAL_BLOCK ] && [ -z $HALT_HEIGHTS ]; then
   echo "Specify FINAL_BLOCK height of the target chain."
   exit 1
 fi
@@ -61,6 +66,39 @@ snapshot() {
   sudo zfs snapshot $ZFS_FS@$snapshot_name
 }
 
+if [ ! -z $HALT_HEIGHTS ]; then
+  while read height time; do
+    snapshot_name=${time:0:10}
+    if zfs list -H -t snapshot "$ZFS_FS@$snapshot_name" > /dev/null 2>&1; then
+      echo "Already have $snapshot_name"
+      continue
+    fi
+
+    echo -n "Syncing to $height... "
+    sudo ufw allow to any port 26656 > /dev/null 2>&1
+    sudo ufw allow out to any port 26656 > /dev/null 2>&1
+    # the node exits by itself once the halt height is committed
+    status=0
+    $NODE_BINARY start --home $DATA_DIR --halt-height $height < /dev/null > $DATA_DIR/node.log 2>&1 || status=$?
+
+    # it may also have exited for some other reason (a crash, a full disk,
+    # an interrupt), so only snapshot once the log shows it stopped at the
+    # halt height, by the halt message or else the last committed height
+    halted=$(sed -n 's/.*halting node per configuration.* height=\([0-9]*\).*/\1/p' $DATA_DIR/node.log | tail -n 1)
+    committed=$(sed -n 's/.*Committed state.* height=\([0-9]*\).*/\1/p' $DATA_DIR/node.log | tail -n 1)
+    if [[ "$halted" != "$height" && "$committed" != "$height" ]]; then
+      echo "FAILED"
+      echo "The node exited with status $status without stopping at $height (last committed height: ${committed:-none}), see $DATA_DIR/node.log"
+      exit 1
+    fi
+    echo "DONE"
+
+    sudo zfs snapshot $ZFS_FS@$snapshot_name
+    echo "SNAPSHOT HEIGHT: $height at $time"
+  done < $HALT_HEIGHTS
+  exit 0
+fi
+
 start_sync
 
 NEXT_DATE=$(date -d "$GENESIS_TIME+$REPORT_FREQUENCY")
@@ -0,0 +1,375 @@
+import re
+import json
+import codecs
+import datetime
+import hashlib
+
+from re import sub
+from os import replace, getpid
+from os.path import dirname, join, abspath
+from urllib.request import urlopen
+
+
+class JsonStream:
+    """Incremental reader over a JSON document that is never held in memory
+    as a whole; values can either be skipped or decoded one at a time."""
+
+    # the next bracket, or the whole of the next string; the closing
+    # quote is missing when the string runs past the end of the buffer
+    __TOKEN = re.compile(r'[{}\[\]]|"[^"\\]*(?:\\.[^"\\]*)*(")?')
+    __SCALAR_END = re.compile(r'[,}\]\s]')
+    __JSON = json.JSONDecoder()
+
+    def __init__(self, reader, chunk_size=1 << 16):
+        self.__reader = reader
+        self.__decoder = codecs.getincrementaldecoder('utf-8')()
+        self.__chunk_size = chunk_size
+        self.__buffer = ''
+        self.__pos = 0
+        self.__mark = None
+        self.__eof = False
+
+    def __fill(self):
+        if self.__eof:
+            return False
+
+        # drop everything that has been consumed, unless a value
+        # is being captured from an earlier position
+        keep = self.__pos if self.__mark is None else self.__mark
+        self.__buffer = self.__buffer[keep:]
+        self.__pos -= keep
+        if self.__mark is not None:
+            self.__mark = 0
+
+        chunk = self.__reader.read(self.__chunk_size)
+        self.__eof = len(chunk) == 0
+        self.__buffer += self.__decoder.decode(chunk, final=self.__eof)
+        return not self.__eof or self.__pos < len(self.__buffer)
+
+    def peek(self):
+        while True:
+            while self.__pos < len(self.__buffer):
+                c = self.__buffer[self.__pos]
+                if c not in ' \t\r\n':
+                    return c
+                self.__pos += 1
+            if not self.__fill():
+                raise ValueError("unexpected end of JSON")
+
+    def expect(self, c):
+        if self.peek() != c:
+            raise ValueError(f"expected {c!r} in JSON")
+        self.__pos += 1
+
+    def skip(self):
+        c = self.peek()
+        if c not in '{["':
+            # a scalar runs up to the next delimiter
+            while True:
+                match = self.__SCALAR_END.search(self.__buffer, self.__pos)
+                if match is not None:
+                    self.__pos = match.start()
+                    return
+                self.__pos = len(self.__buffer)
+                if not self.__fill():
+                    return
+
+        depth = 0
+        while True:
+            match = self.__TOKEN.search(self.__buffer, self.__pos)
+            if match is None or match.group()[0] == '"' and match.group(1) is None:
+                self.__pos = len(self.__buffer) if match is None else match.start()
+                if not self.__fill():
+                    raise ValueError("unexpected end of JSON")
+                continue
+            self.__pos = match.end()
+            c = match.group()
+            if c in '{[':
+                depth += 1
+            elif c in '}]':
+                depth -= 1
+            if depth == 0:
+                return
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.__JSON.raw_decode(self.__buffer, self.__pos)
+                # a number at the very end of the buffer may be incomplete
+                if end < len(self.__buffer) or self.__eof:
+                    self.__pos = end
+                    return value
+            except ValueError:
+                if self.__eof:
+                    raise
+            self.__mark = self.__pos
+            try:
+                self.__fill()
+            finally:
+                self.__mark = None
+
+    def keys(self):
+        """Iterate the keys of an object, leaving the stream at each value;
+        the caller must consume every value before asking for the next key."""
+        self.expect('{')
+        if self.peek() == '}':
+            self.__pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            yield key
+            if self.peek() == ',':
+                self.__pos += 1
+                continue
+            self.expect('}')
+            return
+
+    def items(self):
+        """Iterate an array (or null), leaving the stream at each element."""
+        if self.peek() == 'n':
+            self.skip()
+            return
+        self.expect('[')
+        if self.peek() == ']':
+            self.__pos += 1
+            return
+        while True:
+            yield
+            if self.peek() == ',':
+                self.__pos += 1
+                continue
+            self.expect(']')
+            return
+
+
+class HashingReader:
+    def __init__(self, reader):
+        self.__reader = reader
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size):
+        chunk = self.__reader.read(size)
+        self.sha256.update(chunk)
+        return chunk
+
+
+def open_genesis(source):
+    if re.match(r'^https?://', source):
+        return urlopen(source)
+    return open(source, 'rb')
+
+
+def genesis_hash(source):
+    """sha256 of a local genesis file, as kept in its index; None for one
+    fetched from a node, which is only downloaded when it's indexed."""
+    if re.match(r'^https?://', source):
+        return None
+    sha256 = hashlib.sha256()
+    with open(source, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+# the parts of a genesis document the report needs, by path
+# (None stands for every element of an array)
+GENESIS_PATHS = {
+    ('genesis_time',): 'genesis_time',
+    ('chain_id',): 'chain_id',
+    ('app_state', 'accounts', None): 'account',
+    ('app_state', 'staking', 'params', 'unbonding_time'): 'unbonding_time',
+    ('app_state', 'gov', 'deposit_params', 'max_deposit_period'): 'deposit_time',
+    ('app_state', 'gov', 'voting_params', 'voting_period'): 'voting_time',
+    ('app_state', 'staking', 'delegations', None): 'delegation',
+    ('app_state', 'staking', 'unbonding_delegations', None): 'unbonding_delegation',
+    ('app_state', 'gentxs', None): 'gentx'
+}
+
+
+def read_document(stream, paths):
+    """Yield (kind, value) for every value whose path is in `paths`.
+
+    Accepts either an RPC `/genesis` response or a plain document."""
+    paths = dict(paths)
+    paths.update({('result', 'genesis') + path: kind for (path, kind) in paths.items()})
+    prefixes = {path[:i] for path in paths for i in range(1, len(path))}
+
+    def walk(prefix):
+        for key in stream.keys():
+            path = prefix + (key,)
+            if path in paths:
+                yield paths[path], stream.value()
+            elif path + (None,) in paths:
+                for _ in stream.items():
+                    yield paths[path + (None,)], stream.value()
+            elif path in prefixes and stream.peek() == '{':
+                yield from walk(path)
+            else:
+                stream.skip()
+
+    yield from walk(())
+
+
+class GenesisIndex:
+    """Per-address genesis baseline, built once per chain and kept next to the DB."""
+
+    VERSION = 2
+
+    # the hubs' unbonding period, in case genesis doesn't say
+    DEFAULT_UNBONDING_TIME = str(21 * 24 * 60 * 60 * 10 ** 9)
+    # and their governance deposit and voting periods
+    DEFAULT_DEPOSIT_TIME = str(14 * 24 * 60 * 60 * 10 ** 9)
+    DEFAULT_VOTING_TIME = str(14 * 24 * 60 * 60 * 10 ** 9)
+
+    def __init__(self, chain_id, genesis_hash, genesis_time, denom, accounts, gentxs, unbonding_time,
+                 deposit_time=DEFAULT_DEPOSIT_TIME, voting_time=DEFAULT_VOTING_TIME):
+        self.chain_id = chain_id
+        self.genesis_hash = genesis_hash
+        self.genesis_time = genesis_time
+        self.denom = denom
+        # address -> [balance, bonded, unbonding, self_bond], all in chain denom
+        self.accounts = accounts
+        # (delegator_address, validator_address) of every MsgCreateValidator
+        self.gentxs = gentxs
+        # in nanoseconds, as in the staking params
+        self.unbonding_time = unbonding_time
+        self.deposit_time = deposit_time
+        self.voting_time = voting_time
+
+    @staticmethod
+    def path_for(db_path, chain):
+        return join(dirname(abspath(db_path)), f"{chain}-genesis-index.json")
+
+    @classmethod
+    def build(cls, source, denom):
+        accounts = {}
+        bonded = {}
+        unbonding = {}
+        gentxs = []
+        genesis = {}
+
+        def entry(address):
+            if address not in accounts:
+                accounts[address] = [0, 0, 0, 0]
+            return accounts[address]
+
+        with open_genesis(source) as f:
+            reader = HashingReader(f)
+            for kind, value in read_document(JsonStream(reader), GENESIS_PATHS):
+                if kind == 'account':
+                    try:
+                        entry(value['address'])[0] = int(value['coins'][0]['amount'])
+                    except (IndexError, KeyError, TypeError):
+                        pass
+                elif kind == 'delegation':
+                    address = value['delegator_address']
+                    bonded[address] = bonded.get(address, 0) + float(value['shares'])
+                elif kind == 'unbonding_delegation':
+                    address = value['delegator_address']
+                    unbonding[address] = unbonding.get(address, 0) + \
+                                         sum(map(lambda entry: float(entry['balance']), value['entries']))
+                elif kind == 'gentx':
+                    for msg in value['value']['msg']:
+                        if msg['type'] != 'cosmos-sdk/MsgCreateValidator': continue
+                        gentxs.append((msg['value']['delegator_address'], msg['value']['validator_address']))
+                        if msg['value']['value']['denom'] == denom:
+                            entry(msg['value']['delegator_address'])[3] += int(msg['value']['value']['amount'])
+                else:
+                    genesis[kind] = value
+
+        for address, shares in bonded.items():
+            entry(address)[1] = int(shares)
+        for address, balance in unbonding.items():
+            entry(address)[2] = int(balance)
+
+        return cls(
+            genesis['chain_id'],
+            reader.sha256.hexdigest(),
+            genesis['genesis_time'],
+            denom,
+            accounts,
+            gentxs,
+            genesis.get('unbonding_time', cls.DEFAULT_UNBONDING_TIME),
+            genesis.get('deposit_time', cls.DEFAULT_DEPOSIT_TIME),
+            genesis.get('voting_time', cls.DEFAULT_VOTING_TIME)
+        )
+
+    @classmethod
+    def load(cls, path, chain, denom, genesis_hash=None):
+        """The index saved at `path`, if it is of `chain` and `denom` (and,
+        when given, of the genesis file with `genesis_hash`)."""
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if data.get('version') != cls.VERSION or data['chain_id'] != chain or data['denom'] != denom:
+            return None
+        if genesis_hash is not None and data['genesis_hash'] != genesis_hash:
+            print(f"{path} was built from another genesis file")
+            return None
+
+        return cls(
+            data['chain_id'],
+            data['genesis_hash'],
+            data['genesis_time'],
+            data['denom'],
+            data['accounts'],
+            [tuple(gentx) for gentx in data['gentxs']],
+            data['unbonding_time'],
+            # indexes saved before these were kept have the hubs' periods
+            data.get('deposit_time', cls.DEFAULT_DEPOSIT_TIME),
+            data.get('voting_time', cls.DEFAULT_VOTING_TIME)
+        )
+
+    def save(self, path):
+        # written aside and moved into place, as runs for several
+        # snapshots at once may be loading it
+        with open(f"{path}.{getpid()}.tmp", 'w') as f:
+            json.dump({
+                'version': self.VERSION,
+                'chain_id': self.chain_id,
+                'genesis_hash': self.genesis_hash,
+                'genesis_time': self.genesis_time,
+                'denom': self.denom,
+                'accounts': self.accounts,
+                'gentxs': self.gentxs,
+                'unbonding_time': self.unbonding_time,
+                'deposit_time': self.deposit_time,
+                'voting_time': self.voting_time
+            }, f, separators=(',', ':'))
+        replace(f"{path}.{getpid()}.tmp", path)
+
+    def timestamp(self):
+        genesis_time = sub(r'\.\d+Z$', "Z", self.genesis_time)
+        return datetime.datetime.strptime(genesis_time, "%Y-%m-%dT%H:%M:%SZ")
+
+    def unbonding_period(self):
+        return datetime.timedelta(microseconds=int(self.unbonding_time) // 1000)
+
+    def deposit_refund_period(self):
+        """The longest a proposal deposit can be held before it is
+        refunded: the deposit period and then the voting period."""
+        return datetime.timedelta(microseconds=(int(self.deposit_time) + int(self.voting_time)) // 1000)
+
+    def state(self, address):
+        """The genesis baseline of an account, in base units."""
+        balance, bonded, unbonding, self_bond = self.accounts.get(address, (0, 0, 0, 0))
+
+        # the bond amount is also included in the genesis balance
+        # so in the case of creating validators only, we need to substract
+        # the bonded amount from balance ¯\_(ツ)_/¯
+        balance_at_genesis = balance - self_bond
+        bonded_at_genesis = bonded + self_bond
+        unbonding_at_genesis = unbonding
+
+        return {
+            'balance': balance_at_genesis,
+            'bond': bonded_at_genesis + unbonding_at_genesis,
+            'pending_rewards': 0,
+            'pending_commission': 0,
+            'net_tx': 0
+        }
@@ -0,0 +1,324 @@
+import time
+import random
+import sqlite3
+import threading
+
+from io import BytesIO
+from http.client import HTTPConnection, HTTPSConnection, RemoteDisconnected
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlsplit
+
+from metrics import endpoint
+
+
+class CircuitOpen(URLError):
+    """An endpoint has been failing, so requests to it fail fast for now."""
+
+
+# errors worth trying a request again for, later
+TRANSIENT_ERRORS = (URLError, RemoteDisconnected, ConnectionError, TimeoutError)
+
+
+def is_transient(error):
+    if isinstance(error, HTTPError):
+        # the node is overloaded or broken, rather than the request
+        return error.code >= 500 or error.code == 429
+    return isinstance(error, TRANSIENT_ERRORS)
+
+
+class LoadController:
+    """Limits the requests in flight, AIMD style: the limit grows by one
+    for every `limit` requests answered within `target` seconds, and is
+    halved (at most once per `target` seconds) on a slower one or an
+    error. It starts at a quarter of `maximum`, as a node that was just
+    started is slow to warm up."""
+
+    def __init__(self, maximum, target=2.0, minimum=1):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.target = target
+        self.limit = float(max(minimum, maximum // 4))
+        self.__in_flight = 0
+        self.__decreased = None
+        self.__condition = threading.Condition()
+
+    def acquire(self):
+        with self.__condition:
+            while self.__in_flight >= int(self.limit):
+                self.__condition.wait()
+            self.__in_flight += 1
+
+    def release(self, seconds, ok):
+        with self.__condition:
+            self.__in_flight -= 1
+            if ok and seconds <= self.target:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            else:
+                now = time.monotonic()
+                if self.__decreased is None or now - self.__decreased >= self.target:
+                    self.__decreased = now
+                    self.limit = max(self.minimum, self.limit / 2)
+            self.__condition.notify_all()
+
+
+class CircuitBreaker:
+    """Per endpoint: after `threshold` transient failures in a row, its
+    requests fail fast for `cooldown` seconds, then a single one is let
+    through to see whether it has recovered."""
+
+    def __init__(self, threshold=10, cooldown=10):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.__failures = {}
+        self.__opened = {}
+        self.__probing = set()
+        self.__lock = threading.Lock()
+
+    def allow(self, name):
+        with self.__lock:
+            opened = self.__opened.get(name)
+            if opened is None:
+                return True
+            if time.monotonic() - opened < self.cooldown or name in self.__probing:
+                return False
+            self.__probing.add(name)
+            return True
+
+    def success(self, name):
+        with self.__lock:
+            self.__failures.pop(name, None)
+            self.__opened.pop(name, None)
+            self.__probing.discard(name)
+
+    def release(self, name):
+        """Lets another request through to `name`, when the one let through
+        ended without the node answering either way."""
+        with self.__lock:
+            self.__probing.discard(name)
+
+    def failure(self, name):
+        """Returns True if this failure opened the circuit."""
+        with self.__lock:
+            self.__failures[name] = self.__failures.get(name, 0) + 1
+            probing = name in self.__probing
+            self.__probing.discard(name)
+            if probing or (name not in self.__opened and self.__failures[name] >= self.threshold):
+                self.__opened[name] = time.monotonic()
+                return True
+            return False
+
+    def remaining(self, name=None):
+        """Seconds until the circuit of `name` (or every open circuit)
+        lets a request through."""
+        with self.__lock:
+            now = time.monotonic()
+            return max([
+                opened + self.cooldown - now
+                for (circuit, opened) in self.__opened.items() if name is None or circuit == name
+            ] + [0])
+
+
+class Client:
+    """Keep-alive HTTP client, one persistent connection per thread and host.
+
+    With `metrics` (a metrics.Metrics), every request is counted and timed.
+    Transient failures are tried again up to `retries` times, after a
+    jittered exponential backoff; a `controller` (LoadController) limits
+    the requests in flight and a `breaker` (CircuitBreaker) stops sending
+    requests to a failing endpoint.
+
+    A `probe` is a request whose error responses are expected answers: it
+    is tried once, bypasses the breaker and doesn't slow the controller."""
+
+    def __init__(self, timeout=60, cache=None, metrics=None, retries=0, backoff=0.5, max_backoff=10,
+                 controller=None, breaker=None):
+        self.timeout = timeout
+        self.cache = cache
+        self.metrics = metrics
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.controller = controller
+        self.breaker = breaker
+        self.__local = threading.local()
+
+    def get(self, url, cache=True, probe=False):
+        if cache and self.cache is not None:
+            body = self.cache.get(url)
+            if body is not None:
+                if self.metrics is not None:
+                    self.metrics.request(url, 0, len(body), cached=True)
+                return body
+
+        name = endpoint(url)
+        retries = 0 if probe else self.retries
+        for attempt in range(retries + 1):
+            try:
+                body = self.__attempt(url, name, probe)
+                break
+            except Exception as e:
+                if not is_transient(e) or attempt == retries:
+                    raise
+            if self.metrics is not None:
+                self.metrics.count('retries')
+            # "full jitter", so workers that failed together don't retry
+            # together; an open circuit is waited out
+            delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+            if self.breaker is not None:
+                delay += self.breaker.remaining(name)
+            time.sleep(delay)
+
+        if cache and self.cache is not None:
+            self.cache.put(url, body)
+
+        return body
+
+    def __attempt(self, url, name, probe=False):
+        breaker = None if probe else self.breaker
+        if breaker is not None and not breaker.allow(name):
+            raise CircuitOpen(f"{name} is failing")
+
+        if self.controller is not None:
+            self.controller.acquire()
+        start = time.monotonic()
+        try:
+            body = self.__get(url)
+        except Exception as e:
+            seconds = time.monotonic() - start
+            # a probe's error responses are answers, not failures
+            transient = is_transient(e) and not (probe and isinstance(e, HTTPError))
+            if self.controller is not None:
+                # a request the node turned down quickly isn't load
+                self.controller.release(seconds, not transient)
+            if breaker is not None:
+                if transient:
+                    if breaker.failure(name) and self.metrics is not None:
+                        self.metrics.count('circuits_opened')
+                elif isinstance(e, HTTPError):
+                    # the node answered, if not with what was asked for
+                    breaker.success(name)
+                else:
+                    breaker.release(name)
+            if self.metrics is not None:
+                self.metrics.request(url, seconds, 0, error=True)
+            raise
+        seconds = time.monotonic() - start
+        if self.controller is not None:
+            self.controller.release(seconds, True)
+        if breaker is not None:
+            breaker.success(name)
+        if self.metrics is not None:
+            self.metrics.request(url, seconds, len(body))
+
+        return body
+
+    def __get(self, url):
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += f"?{parts.query}"
+
+        # a keep-alive connection may have been dropped by the server since
+        # it was last used, so retry exactly once on a fresh connection
+        for attempt in range(2):
+            conn = self.__connection(parts.scheme, parts.netloc)
+            try:
+                conn.request('GET', path, headers={'Connection': 'keep-alive'})
+                response = conn.getresponse()
+                body = response.read()
+                break
+            except (RemoteDisconnected, ConnectionError, BrokenPipeError):
+                self.__discard(parts.netloc)
+                if attempt == 1:
+                    raise
+            except OSError as e:
+                self.__discard(parts.netloc)
+                raise URLError(e)
+
+        if response.will_close:
+            self.__discard(parts.netloc)
+
+        if response.status >= 400:
+            raise HTTPError(url, response.status, response.reason, response.headers, BytesIO(body))
+
+        return body
+
+    def close(self):
+        for conn in self.__connections().values():
+            conn.close()
+        self.__connections().clear()
+
+    def __connections(self):
+        if not hasattr(self.__local, 'connections'):
+            self.__local.connections = {}
+        return self.__local.connections
+
+    def __connection(self, scheme, netloc):
+        connections = self.__connections()
+        if netloc not in connections:
+            cls = HTTPSConnection if scheme == 'https' else HTTPConnection
+            connections[netloc] = cls(netloc, timeout=self.timeout)
+        return connections[netloc]
+
+    def __discard(self, netloc):
+        conn = self.__connections().pop(netloc, None)
+        if conn is not None:
+            conn.close()
+
+
+class ResponseCache:
+    """Successful responses for one chain at one height, kept on disk so
+    that a rerun at the same height doesn't request them again.
+
+    Responses are kept by path and query only, as a rerun may well reach
+    the same node on another host or port."""
+
+    def __init__(self, path, chain, height):
+        self.path = path
+        self.chain = chain
+        self.height = str(height)
+        self.__local = threading.local()
+
+        with self.__connection() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS responses (
+                    chain TEXT,
+                    height TEXT,
+                    url TEXT,
+                    body BLOB,
+                    PRIMARY KEY (chain, height, url)
+                )
+            ''')
+
+    def __connection(self):
+        if not hasattr(self.__local, 'conn'):
+            self.__local.conn = sqlite3.connect(self.path, timeout=60)
+            self.__local.conn.execute('PRAGMA journal_mode = WAL')
+            self.__local.conn.execute('PRAGMA synchronous = NORMAL')
+        return self.__local.conn
+
+    def get(self, url):
+        row = self.__connection().execute('''
+            SELECT body FROM responses
+            WHERE chain = ? AND height = ? AND url = ?
+        ''', (self.chain, self.height, key(url))).fetchone()
+        return row[0] if row else None
+
+    def put(self, url, body):
+        with self.__connection() as conn:
+            conn.execute('''
+                INSERT OR REPLACE INTO responses (chain, height, url, body)
+                VALUES (?, ?, ?, ?)
+            ''', (self.chain, self.height, key(url), body))
+
+    def clear(self):
+        with self.__connection() as conn:
+            conn.execute('''
+                DELETE FROM responses
+                WHERE chain = ? AND height = ?
+            ''', (self.chain, self.height))
+
+
+def key(url):
+    parts = urlsplit(url)
+    return f"{parts.path}?{parts.query}" if parts.query else parts.path
@@ -0,0 +1,35 @@
+import threading
+
+from collections import OrderedDict
+
+
+class LruCache:
+    """Values by key, shared by every thread; beyond `size` the least
+    recently used are dropped. `hits` and `misses` count the lookups."""
+
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.__values = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, key):
+        with self.__lock:
+            value = self.__values.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.__values.move_to_end(key)
+                self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.__lock:
+            self.__values[key] = value
+            if len(self.__values) > self.size:
+                self.__values.popitem(last=False)
+
+    def clear(self):
+        with self.__lock:
+            self.__values.clear()
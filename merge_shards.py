@@ -0,0 +1,269 @@
+import sqlite3
+
+from argparse import ArgumentParser
+
+from schema import ROLLUPS, init_schema, backfill_rollups, snapshot_income_sql, add_rollups
+
+
+class Db:
+    def __init__(self, path, scale=6):
+        self.__conn = sqlite3.connect(path)
+        self.__conn.row_factory = sqlite3.Row
+        self.__conn.execute('PRAGMA journal_mode = WAL')
+        self.__conn.execute('PRAGMA synchronous = NORMAL')
+        self.__scale = scale
+        init_schema(self.__conn, scale)
+        # the snapshots merged since the rollups were last updated, kept in
+        # the database so that ones merged just before a crash still have
+        # their net transaction flow and rollups worked out by the next merge
+        self.__conn.execute('''
+            CREATE TABLE IF NOT EXISTS merged (
+                account_id INTEGER,
+                timestamp TIMESTAMP,
+                PRIMARY KEY (account_id, timestamp)
+            )
+        ''')
+        self.__conn.commit()
+
+    def commit(self):
+        self.__conn.commit()
+
+    def get_latest_report_date(self):
+        c = self.__conn.cursor()
+        c.execute('''
+            SELECT date(MAX(timestamp)) FROM account_snapshots
+        ''')
+        return c.fetchone()[0]
+
+    def has_completed_run(self, date):
+        c = self.__conn.cursor()
+        c.execute('''
+            SELECT COUNT(1) FROM runs
+            WHERE completed_at IS NOT NULL AND date(timestamp) = ?
+        ''', (date,))
+        return c.fetchone()[0] > 0
+
+    def seed(self, path):
+        """Start a new database at `path` with just what a run needs to carry
+        on from this one: the accounts, indexes and checkpoints, and the
+        latest snapshot of each account."""
+        self.__open(path)
+        c = self.__conn.cursor()
+        c.execute('ATTACH DATABASE ? AS shard', (path,))
+        try:
+            with self.__conn:
+                # account ids are kept, so the shard's match these
+                for table in ('accounts', 'transactions', 'activity', 'checkpoints'):
+                    c.execute(f"INSERT OR IGNORE INTO shard.{table} SELECT * FROM main.{table}")
+                c.execute('''
+                    INSERT OR IGNORE INTO shard.account_snapshots
+                    SELECT * FROM main.account_snapshots s
+                    WHERE timestamp = (
+                        SELECT MAX(timestamp) FROM main.account_snapshots
+                        WHERE account_id = s.account_id
+                    )
+                ''')
+        finally:
+            c.execute('DETACH DATABASE shard')
+
+    def merge(self, path):
+        """Fold one shard database in, returning the number of snapshots
+        added. Snapshots already in this database, by address and
+        timestamp, are skipped, so shards can start from a copy of it."""
+        self.__open(path)
+        c = self.__conn.cursor()
+        c.execute('ATTACH DATABASE ? AS shard', (path,))
+        try:
+            with self.__conn:
+                c.execute('''
+                    INSERT OR IGNORE INTO accounts (address, valoper)
+                    SELECT address, valoper FROM shard.accounts
+                    ORDER BY id ASC
+                ''')
+                c.execute('''
+                    UPDATE accounts SET valoper = (
+                        SELECT valoper FROM shard.accounts
+                        WHERE shard.accounts.address = accounts.address
+                    )
+                    WHERE valoper IS NULL
+                ''')
+                for table in ('transactions', 'activity', 'failed_accounts'):
+                    c.execute(f"INSERT OR IGNORE INTO main.{table} SELECT * FROM shard.{table}")
+                # the furthest of each checkpoint
+                c.execute('''
+                    INSERT OR IGNORE INTO main.checkpoints (chain, name, page, height)
+                    SELECT chain, name, page, height FROM shard.checkpoints
+                ''')
+                c.execute('''
+                    UPDATE main.checkpoints SET
+                        page = MAX(page, (SELECT page FROM shard.checkpoints s
+                                          WHERE s.chain = checkpoints.chain AND s.name = checkpoints.name)),
+                        height = MAX(height, (SELECT height FROM shard.checkpoints s
+                                              WHERE s.chain = checkpoints.chain AND s.name = checkpoints.name))
+                    WHERE (chain, name) IN (SELECT chain, name FROM shard.checkpoints)
+                ''')
+
+                # the shard's account ids are its own, so snapshots are
+                # matched up by address
+                c.execute('''
+                    CREATE TEMP TABLE incoming AS
+                    SELECT main_accounts.id AS account_id, s.timestamp, s.height, s.balance, s.bond,
+                           s.pending_rewards, s.pending_commission, s.net_tx
+                    FROM shard.account_snapshots s
+                    JOIN shard.accounts shard_accounts ON shard_accounts.id = s.account_id
+                    JOIN main.accounts main_accounts ON main_accounts.address = shard_accounts.address
+                    WHERE NOT EXISTS (
+                        SELECT 1 FROM main.account_snapshots m
+                        WHERE m.account_id = main_accounts.id AND m.timestamp = s.timestamp
+                    )
+                ''')
+                c.execute('''
+                    INSERT OR IGNORE INTO merged (account_id, timestamp)
+                    SELECT account_id, timestamp FROM temp.incoming
+                ''')
+                c.execute('''
+                    INSERT INTO main.account_snapshots (account_id, timestamp, height, balance, bond,
+                                                        pending_rewards, pending_commission, net_tx)
+                    SELECT * FROM temp.incoming
+                    ORDER BY account_id ASC, timestamp ASC
+                ''')
+                count = c.rowcount
+                c.execute('DROP TABLE temp.incoming')
+                return count
+        finally:
+            c.execute('DETACH DATABASE shard')
+
+    def complete_runs(self, paths):
+        """Record the runs that every shard completed."""
+        runs = None
+        for path in paths:
+            conn = sqlite3.connect(path)
+            completed = {
+                (chain, height): (timestamp, completed_at)
+                for (chain, height, timestamp, completed_at) in conn.execute('''
+                    SELECT chain, height, timestamp, completed_at FROM runs
+                    WHERE completed_at IS NOT NULL
+                ''')
+            }
+            conn.close()
+            runs = completed if runs is None else {
+                run: (timestamp, max(completed_at, completed[run][1]))
+                for (run, (timestamp, completed_at)) in runs.items() if run in completed
+            }
+
+        self.__conn.executemany('''
+            INSERT OR REPLACE INTO runs (chain, height, timestamp, completed_at)
+            VALUES (?, ?, ?, ?)
+        ''', [(chain, height, timestamp, completed_at) for ((chain, height), (timestamp, completed_at)) in (runs or {}).items()])
+        return len(runs or {})
+
+    def recompute_net_tx(self):
+        """Work the net transaction flow of the snapshots merged since the
+        last rollups out again, against the snapshot before each one here;
+        a shard that started from an older copy measured a longer interval."""
+        self.__conn.execute('''
+            UPDATE account_snapshots SET net_tx = COALESCE((
+                SELECT
+                    (SELECT COALESCE(SUM(amount), 0) FROM transactions
+                     WHERE recipient = accounts.address AND timestamp > previous.timestamp AND timestamp <= account_snapshots.timestamp)
+                    -
+                    (SELECT COALESCE(SUM(amount + fee), 0) FROM transactions
+                     WHERE sender = accounts.address AND timestamp > previous.timestamp AND timestamp <= account_snapshots.timestamp)
+                FROM accounts, (
+                    SELECT timestamp FROM account_snapshots AS p
+                    WHERE p.account_id = account_snapshots.account_id AND p.timestamp < account_snapshots.timestamp
+                    ORDER BY p.timestamp DESC
+                    LIMIT 1
+                ) AS previous
+                WHERE accounts.id = account_snapshots.account_id
+            ), net_tx)
+            WHERE (account_id, timestamp) IN (SELECT account_id, timestamp FROM merged) AND height != 0
+        ''')
+
+    def append_rollups(self):
+        """Add the income of the snapshots merged since the last rollups,
+        when they all came after the snapshots already here. Like
+        `rebuild_rollups`, it is only committed with `commit`, so the
+        rollups and the runs they complete are written together."""
+        c = self.__conn.cursor()
+        c.execute(f'''
+            CREATE TEMP TABLE appended AS
+            {snapshot_income_sql('(n.account_id, n.timestamp) IN (SELECT account_id, timestamp FROM merged)')}
+        ''')
+        for (resolution, period_format) in ROLLUPS.items():
+            add_rollups(self.__conn, c.execute('''
+                SELECT address, ?, strftime(?, timestamp) AS period, SUM(income), COUNT(1)
+                FROM temp.appended
+                GROUP BY address, period
+            ''', (resolution, period_format)).fetchall())
+        c.execute('DROP TABLE temp.appended')
+        c.execute('DELETE FROM merged')
+
+    def rebuild_rollups(self):
+        """Recompute the income rollups of every account that was merged,
+        as snapshots may have landed between ones already rolled up."""
+        c = self.__conn.cursor()
+        c.execute('''
+            CREATE TEMP TABLE merged_addresses AS
+            SELECT DISTINCT address FROM accounts
+            JOIN merged ON merged.account_id = accounts.id
+        ''')
+        c.execute('''
+            DELETE FROM income_rollups
+            WHERE address IN (SELECT address FROM temp.merged_addresses)
+        ''')
+        backfill_rollups(self.__conn, 'n.account_id IN (SELECT account_id FROM merged)')
+
+        # periods only ever gain snapshots, so the ones the merged
+        # accounts have now are all the ones that can have changed
+        c.execute('''
+            CREATE TEMP TABLE periods AS
+            SELECT DISTINCT resolution, period FROM income_rollups
+            WHERE address IN (SELECT address FROM temp.merged_addresses)
+        ''')
+        c.execute('''
+            DELETE FROM network_income_rollups
+            WHERE (resolution, period) IN (SELECT resolution, period FROM temp.periods)
+        ''')
+        c.execute('''
+            INSERT INTO network_income_rollups (resolution, period, income, snapshots)
+            SELECT resolution, period, SUM(income), SUM(snapshots)
+            FROM income_rollups
+            WHERE (resolution, period) IN (SELECT resolution, period FROM temp.periods)
+            GROUP BY resolution, period
+        ''')
+        c.execute('DROP TABLE temp.periods')
+        c.execute('DROP TABLE temp.merged_addresses')
+        c.execute('DELETE FROM merged')
+
+    def __open(self, path):
+        # creates the tables of a new database, and converts
+        # one written in the old layout
+        conn = sqlite3.connect(path)
+        init_schema(conn, self.__scale)
+        conn.close()
+
+
+if __name__ == '__main__':
+    # parse command line arguments
+    parser = ArgumentParser(description="Merge databases written by `calculate_earnings.py --shard` into one")
+    parser.add_argument('--db-path', required=True, help="path to the sqlite3 database to merge into")
+    parser.add_argument('--scale', default=6, type=int, help="scale factor of amounts in databases from before they were kept in base units")
+    parser.add_argument('shards', nargs='+', help="paths to the shard databases")
+    args = parser.parse_args()
+
+
+    db = Db(args.db_path, args.scale)
+
+    for path in args.shards:
+        print(f"Merging {path}...")
+        count = db.merge(path)
+        print(f"\t{count} snapshots DONE")
+
+    print("Rebuilding income rollups... ")
+    db.rebuild_rollups()
+
+    runs = db.complete_runs(args.shards)
+    db.commit()
+    print(f"Completed runs: {runs}")
+    print("DONE")
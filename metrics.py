@@ -0,0 +1,115 @@
+import re
+import json
+import time
+import threading
+
+from os import replace
+from contextlib import contextmanager
+from urllib.parse import urlsplit, parse_qsl
+
+
+# upper bounds of the latency histogram buckets, in milliseconds
+LATENCY_BUCKETS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000]
+
+
+def endpoint(url):
+    """The template of a request, such as /bank/balances/{address}, so
+    requests for different accounts are counted together."""
+    def template(value):
+        if re.match(r'^cosmosvaloper1[0-9a-z]+$', value): return '{valoper}'
+        if re.match(r'^cosmos1[0-9a-z]+$', value): return '{address}'
+        if re.match(r'^\d+$', value): return '{n}'
+        if re.match(r'^[0-9A-Fa-f]{64}$', value): return '{hash}'
+        return value
+
+    parts = urlsplit(url)
+    path = '/'.join(map(template, parts.path.split('/')))
+    query = '&'.join(f"{key}={template(value)}" for (key, value) in parse_qsl(parts.query))
+    return f"{path}?{query}" if query else path
+
+
+class Metrics:
+    """Counters and timers for one run, updated from any thread."""
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.started = time.monotonic()
+        self.endpoints = {}
+        self.phases = {}
+        self.counters = {}
+        self.fallbacks = {}
+
+    def request(self, url, seconds, size, cached=False, error=False):
+        name = endpoint(url)
+        with self.__lock:
+            stats = self.endpoints.get(name)
+            if stats is None:
+                stats = self.endpoints[name] = {
+                    'requests': 0, 'cached': 0, 'errors': 0, 'bytes': 0,
+                    'seconds': 0.0, 'max_seconds': 0.0,
+                    'histogram': [0] * (len(LATENCY_BUCKETS) + 1)
+                }
+            stats['requests'] += 1
+            stats['bytes'] += size
+            if cached:
+                stats['cached'] += 1
+                return
+            if error:
+                stats['errors'] += 1
+            stats['seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+            bucket = next((i for (i, bound) in enumerate(LATENCY_BUCKETS) if seconds * 1000 <= bound), len(LATENCY_BUCKETS))
+            stats['histogram'][bucket] += 1
+
+    @contextmanager
+    def phase(self, name):
+        """Time a block; time spent in the same phase adds up, across threads too."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            with self.__lock:
+                self.phases[name] = self.phases.get(name, 0.0) + time.monotonic() - start
+
+    def count(self, name, n=1):
+        with self.__lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def fallback(self, name):
+        """A value that couldn't be retrieved and was recorded as `0`."""
+        with self.__lock:
+            self.fallbacks[name] = self.fallbacks.get(name, 0) + 1
+
+    def profile(self, **run):
+        with self.__lock:
+            elapsed = time.monotonic() - self.started
+            accounts = self.counters.get('accounts', 0)
+            collection = self.phases.get('collection', 0.0)
+            return {
+                **run,
+                'seconds': round(elapsed, 3),
+                'accounts_per_second': round(accounts / collection, 3) if collection > 0 else None,
+                'phases': {name: round(seconds, 3) for (name, seconds) in self.phases.items()},
+                'counters': dict(self.counters),
+                'fallbacks_to_zero': dict(self.fallbacks),
+                'endpoints': {
+                    name: {
+                        **{key: value for (key, value) in stats.items() if key != 'histogram'},
+                        'seconds': round(stats['seconds'], 3),
+                        'max_seconds': round(stats['max_seconds'], 3),
+                        'mean_seconds': round(stats['seconds'] / (stats['requests'] - stats['cached']), 4)
+                                        if stats['requests'] > stats['cached'] else None,
+                        'histogram_ms': {
+                            (f"<={bound}" if i < len(LATENCY_BUCKETS) else f">{LATENCY_BUCKETS[-1]}"): count
+                            for (i, (bound, count)) in enumerate(zip(LATENCY_BUCKETS + [None], stats['histogram']))
+                            if count > 0
+                        }
+                    }
+                    for (name, stats) in sorted(self.endpoints.items())
+                }
+            }
+
+    def save(self, path, **run):
+        with open(f"{path}.tmp", 'w') as f:
+            json.dump(self.profile(**run), f, indent=2, default=str)
+        replace(f"{path}.tmp", path)
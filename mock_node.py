@@ -0,0 +1,309 @@
+import json
+import time
+import random
+import sqlite3
+import datetime
+import hashlib
+import threading
+import bech32
+
+from bisect import bisect_right
+from argparse import ArgumentParser
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+
+GENESIS_TIME = datetime.datetime(2019, 3, 13, 23, 0, 0)
+BLOCK_SECONDS = 6
+
+# what --error-rate fails: everything about accounts and transactions,
+# but not the node's status or genesis
+FLAKY_ENDPOINTS = ('/bank/balances/', '/staking/', '/distribution/', '/txs')
+
+# other message types that are indexed for --incremental, spread
+# over the chain along with the sends
+ACTIVITY_TYPES = {
+    'withdraw_delegator_reward': 'cosmos-sdk/MsgWithdrawDelegationReward',
+    'vote': 'cosmos-sdk/MsgVote'
+}
+
+
+def block_time(height):
+    return GENESIS_TIME + datetime.timedelta(seconds=height * BLOCK_SECONDS)
+
+
+def format_time(time, fraction=False):
+    return time.strftime('%Y-%m-%dT%H:%M:%S') + ('.000000000Z' if fraction else 'Z')
+
+
+class SyntheticChain:
+    """A made up chain of `accounts` accounts, the first few of them
+    validators, which can be served at any height.
+
+    Every account delegates once in the first `delegate_height` blocks;
+    sends and other activity are spread over the first `span` blocks and
+    only served up to the current height. Balances, rewards and commission
+    change with the height."""
+
+    def __init__(self, accounts, height, seed=1, chain_id='mock-1', delegate_height=10000, span=43200):
+        self.chain_id = chain_id
+        self.height = height
+        rnd = random.Random(seed)
+
+        self.addresses = [
+            bech32.encode('cosmos', [b % 32 for b in hashlib.sha256(f"{seed}:{i}".encode()).digest()])
+            for i in range(accounts)
+        ]
+        self.index = {address: i for (i, address) in enumerate(self.addresses)}
+        self.validators = [
+            bech32.encode('cosmosvaloper', bech32.decode(address)[1])
+            for address in self.addresses[:max(3, min(125, accounts // 100))]
+        ]
+        self.valoper_index = {valoper: i for (i, valoper) in enumerate(self.validators)}
+
+        def tx(height, msg_type, value):
+            return {
+                'height': str(height),
+                'txhash': hashlib.sha256(f"{seed}:{height}:{json.dumps(value, sort_keys=True)}".encode()).hexdigest().upper(),
+                'timestamp': format_time(block_time(height)),
+                'logs': [{'success': True}],
+                'tx': {'type': 'auth/StdTx', 'value': {
+                    'msg': [{'type': msg_type, 'value': value}],
+                    'fee': {'amount': [{'denom': 'uatom', 'amount': '5000'}]}
+                }}
+            }
+
+        self.txs = {'delegate': [], 'send': []}
+        for i in range(len(self.validators), accounts):
+            self.txs['delegate'].append(tx(1 + (i * delegate_height) // accounts, 'cosmos-sdk/MsgDelegate', {
+                'delegator_address': self.addresses[i],
+                'validator_address': self.validators[i % len(self.validators)],
+                'amount': {'denom': 'uatom', 'amount': '1000000'}
+            }))
+        for n in sorted(rnd.randrange(1, span) for _ in range(accounts // 2)):
+            sender, recipient = rnd.sample(self.addresses, 2)
+            self.txs['send'].append(tx(n, 'cosmos-sdk/MsgSend', {
+                'from_address': sender,
+                'to_address': recipient,
+                'amount': [{'denom': 'uatom', 'amount': str(rnd.randrange(1, 10 ** 9))}]
+            }))
+        for (action, msg_type) in ACTIVITY_TYPES.items():
+            self.txs[action] = [
+                tx(n, msg_type, {'delegator_address': rnd.choice(self.addresses), 'validator_address': rnd.choice(self.validators)})
+                for n in sorted(rnd.randrange(1, span) for _ in range(accounts // 8))
+            ]
+
+        # every list of txs is in height order
+        self.heights = {action: [int(tx['height']) for tx in txs] for (action, txs) in self.txs.items()}
+
+        self.sends_by = {'sender': {}, 'recipient': {}}
+        for send in self.txs['send']:
+            value = send['tx']['value']['msg'][0]['value']
+            self.sends_by['sender'].setdefault(value['from_address'], []).append(send)
+            self.sends_by['recipient'].setdefault(value['to_address'], []).append(send)
+
+        self.genesis = json.dumps({'result': {'genesis': {
+            'genesis_time': format_time(GENESIS_TIME, fraction=True),
+            'chain_id': chain_id,
+            'app_state': {
+                'accounts': [
+                    {'address': address, 'coins': [{'denom': 'uatom', 'amount': str(self.__base(i))}]}
+                    for (i, address) in enumerate(self.addresses[:accounts // 2])
+                ],
+                'staking': {
+                    'params': {'unbonding_time': '1814400000000000'},
+                    'delegations': [],
+                    'unbonding_delegations': []
+                },
+                'gentxs': [
+                    {'type': 'auth/StdTx', 'value': {'msg': [{'type': 'cosmos-sdk/MsgCreateValidator', 'value': {
+                        'delegator_address': self.addresses[i],
+                        'validator_address': valoper,
+                        'value': {'denom': 'uatom', 'amount': '100000000'}
+                    }}]}}
+                    for (i, valoper) in enumerate(self.validators)
+                ]
+            }
+        }}}).encode('utf-8')
+
+    def __base(self, i):
+        return 1000000 * (1 + i % 97)
+
+    def status(self):
+        return {'result': {
+            'node_info': {'network': self.chain_id},
+            'sync_info': {
+                'latest_block_height': str(self.height),
+                'latest_block_time': format_time(block_time(self.height), fraction=True)
+            }
+        }}
+
+    def blockchain(self, min_height, max_height):
+        max_height = min(max_height, self.height)
+        return {'result': {'last_height': str(self.height), 'block_metas': [
+            {'header': {'height': str(height), 'time': format_time(block_time(height), fraction=True)}}
+            for height in range(max_height, max(min_height, max_height - 19) - 1, -1)
+        ]}}
+
+    def balance(self, address):
+        i = self.index.get(address)
+        if i is None: return None
+        return [{'denom': 'uatom', 'amount': str(self.__base(i) + self.height * (i % 5))}]
+
+    def delegations(self, address):
+        i = self.index.get(address)
+        if i is None or i % 2 == 1: return None
+        return [{
+            'delegator_address': address,
+            'validator_address': self.validators[i % len(self.validators)],
+            'shares': f"{self.__base(i) // 2}.{(i * 7919) % 10 ** 18:018d}"
+        }]
+
+    def unbonding_delegations(self, address):
+        i = self.index.get(address)
+        if i is None or i % 20 != 0: return None
+        return [{
+            'delegator_address': address,
+            'validator_address': self.validators[0],
+            'entries': [{'creation_height': '1', 'balance': '1000'}]
+        }]
+
+    def rewards(self, address):
+        i = self.index.get(address)
+        if i is None or i % 2 == 1: return None
+        return [{'denom': 'uatom', 'amount': f"{self.height * (1 + i % 7)}.{(i * self.height) % 10 ** 18:018d}"}]
+
+    def commission(self, valoper):
+        i = self.valoper_index.get(valoper)
+        if i is None: return None
+        return {'operator_address': valoper, 'val_commission': [{'denom': 'uatom', 'amount': f"{self.height * (11 + i)}.5"}]}
+
+    def validator_set(self, status, page, limit):
+        if status != 'bonded': return []
+        return [{'operator_address': valoper} for valoper in self.validators[(page - 1) * limit:page * limit]]
+
+    def search(self, action, page, limit, sender=None, recipient=None):
+        if sender is not None or recipient is not None:
+            txs = self.sends_by['sender'].get(sender, []) if sender is not None else \
+                  self.sends_by['recipient'].get(recipient, [])
+            return [tx for tx in txs if int(tx['height']) <= self.height][:limit]
+        if action not in self.txs: return []
+        served = bisect_right(self.heights[action], self.height)
+        return self.txs[action][min(served, (page - 1) * limit):min(served, page * limit)]
+
+
+class Replay:
+    """Responses recorded in a response cache database (see
+    `calculate_earnings.py --keep-cache`), by path and query."""
+
+    def __init__(self, path, height=None):
+        conn = sqlite3.connect(path)
+        rows = conn.execute('''
+            SELECT url, body FROM responses
+            WHERE ? IS NULL OR height = ?
+        ''', (height, height))
+        self.responses = {}
+        for (url, body) in rows:
+            parts = urlsplit(url)
+            self.responses[f"{parts.path}?{parts.query}" if parts.query else parts.path] = body
+        conn.close()
+
+    def get(self, path):
+        return self.responses.get(path)
+
+
+def make_handler(chain, replay=None, latency=0, jitter=0, error_rate=0, seed=1):
+    rnd = random.Random(seed)
+    lock = threading.Lock()
+
+    def route(parts, query):
+        path = parts.path
+        first = lambda name, default=None: query.get(name, [default])[0]
+        if path == '/status':
+            return chain.status()
+        if path == '/node_info':
+            return {'network': chain.chain_id}
+        if path == '/blockchain':
+            return chain.blockchain(int(first('minHeight', 1)), int(first('maxHeight', chain.height)))
+        if path.startswith('/bank/balances/'):
+            return chain.balance(path.split('/')[-1])
+        if path.startswith('/staking/delegators/') and path.endswith('/unbonding_delegations'):
+            return chain.unbonding_delegations(path.split('/')[-2])
+        if path.startswith('/staking/delegators/') and path.endswith('/delegations'):
+            return chain.delegations(path.split('/')[-2])
+        if path.startswith('/distribution/delegators/') and path.endswith('/rewards'):
+            return chain.rewards(path.split('/')[-2])
+        if path.startswith('/distribution/validators/'):
+            commission = chain.commission(path.split('/')[-1])
+            if commission is None: raise LookupError(path)
+            return commission
+        if path == '/staking/validators':
+            return chain.validator_set(first('status', 'bonded'), int(first('page', 1)), int(first('limit', 100)))
+        if path == '/txs':
+            return chain.search(first('action'), int(first('page', 1)), int(first('limit', 30)),
+                                first('sender'), first('recipient'))
+        raise LookupError(path)
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # small responses on keep-alive connections, so don't wait on Nagle
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            parts = urlsplit(self.path)
+            with lock:
+                delay = max(0, rnd.uniform(latency - jitter, latency + jitter)) / 1000
+                fail = rnd.random() < error_rate
+            if delay > 0:
+                time.sleep(delay)
+
+            status, body = 200, None
+            if parts.path == '/genesis':
+                body = chain.genesis
+            elif replay is not None and replay.get(self.path) is not None:
+                body = replay.get(self.path)
+            elif fail and parts.path.startswith(FLAKY_ENDPOINTS):
+                status, body = 500, b'{"error":"injected"}'
+            else:
+                try:
+                    body = json.dumps(route(parts, parse_qs(parts.query)), separators=(',', ':')).encode('utf-8')
+                except LookupError:
+                    status, body = (500 if parts.path.startswith('/distribution/') else 404), b'{"error":"not found"}'
+
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return Handler
+
+
+if __name__ == '__main__':
+    # parse command line arguments
+    parser = ArgumentParser(description="Serve a synthetic (or recorded) chain as a node's RPC and LCD, on one port")
+    parser.add_argument('--port', default=26657, type=int)
+    parser.add_argument('--accounts', default=1000, type=int, help="number of accounts on the synthetic chain")
+    parser.add_argument('--height', default=14400, type=int, help="height to serve the chain at")
+    parser.add_argument('--seed', default=1, type=int)
+    parser.add_argument('--latency', default=0, type=float, help="milliseconds to wait before each response")
+    parser.add_argument('--jitter', default=0, type=float, help="milliseconds the latency varies by, either way")
+    parser.add_argument('--error-rate', default=0, type=float, help="fraction of account and transaction requests to fail with a 500")
+    parser.add_argument('--replay', help="response cache database to serve recorded responses from, before the synthetic ones")
+    parser.add_argument('--replay-height', help="only replay responses recorded at this height")
+    args = parser.parse_args()
+
+
+    print(f"Generating {args.accounts} accounts... ")
+    chain = SyntheticChain(args.accounts, args.height, args.seed)
+    replay = Replay(args.replay, args.replay_height) if args.replay else None
+
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), make_handler(
+        chain, replay, args.latency, args.jitter, args.error_rate, args.seed
+    ))
+    server.daemon_threads = True
+    print(f"Serving height {args.height} on http://127.0.0.1:{args.port}", flush=True)
+    server.serve_forever()
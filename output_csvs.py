@@ -2,19 +2,65 @@ import sqlite3
 import datetime
 import traceback
 import csv
+import json
 
 from sys import exit
 from argparse import ArgumentParser
-from os.path import dirname, join
-from os import mkdir
+from os.path import dirname, join, exists
+from os import mkdir, replace
 from re import sub
 from collections import OrderedDict
+from decimal import Decimal
+from multiprocessing import Pool
+
+from analytics import Snapshots, NetworkAggregates
+
+
+# income is worked out from these by analytics.Snapshots
+SNAPSHOTS_QUERY = '''
+    SELECT accounts.address, account_snapshots.timestamp, height, balance, bond,
+           pending_rewards, pending_commission, net_tx, NULL AS id
+    FROM account_snapshots
+    JOIN accounts ON accounts.id = account_snapshots.account_id
+    {join}
+    WHERE {where}
+    ORDER BY account_snapshots.account_id ASC, account_snapshots.timestamp ASC
+'''
+
+# databases calculate_earnings.py hasn't converted yet, with scaled
+# amounts in one `snapshots` table
+LEGACY_SNAPSHOTS_QUERY = '''
+    SELECT snapshots.address, snapshots.timestamp, height, balance, bond,
+           pending_rewards, pending_commission, net_tx, snapshots.id
+    FROM snapshots
+    {join}
+    WHERE {where}
+    ORDER BY snapshots.address ASC, snapshots.timestamp ASC, snapshots.id ASC
+'''
+
+FIELDS = [
+    'timestamp', 'height', 'balance', 'bond',
+    'pending_rewards', 'pending_commission', 'net_tx', 'income'
+]
+
+AMOUNT_FIELDS = ['balance', 'bond', 'pending_rewards', 'pending_commission', 'net_tx', 'income']
+
+
+def to_denom(amount, scale):
+    # exact, where floats would show 0.30000000000000004
+    return None if amount is None else f"{Decimal(amount).scaleb(-scale):f}"
 
 
 class Db:
-    def __init__(self, path):
+    def __init__(self, path, scale=6):
         self.__conn = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
         self.__conn.row_factory = sqlite3.Row
+        self.legacy = self.__conn.execute('''
+            SELECT COUNT(1) FROM sqlite_master
+            WHERE type = 'table' AND name = 'account_snapshots'
+        ''').fetchone()[0] == 0
+        # amounts are in base units, except in the old layout
+        self.scale = None if self.legacy else scale
 
     def get_accounts(self):
         c = self.__conn.cursor()
@@ -24,69 +70,294 @@ class Db:
         return list(map(lambda row: row['address'], c.fetchall()))
 
     def get_full_report(self, address):
+        c = self.__conn.cursor()
+        query = LEGACY_SNAPSHOTS_QUERY if self.legacy else SNAPSHOTS_QUERY
+        r = c.execute(query.format(join='', where='address = ?'), (address,))
+        return [row for (address, rows) in Snapshots.from_rows(r).accounts() for row in rows]
+
+    def get_latest_run(self):
+        """The latest completed run, or None."""
+        c = self.__conn.cursor()
+        try:
+            row = c.execute('''
+                SELECT chain, height, timestamp, completed_at FROM runs
+                WHERE completed_at IS NOT NULL
+                ORDER BY timestamp DESC
+                LIMIT 1
+            ''').fetchone()
+        except sqlite3.OperationalError:
+            return None
+        return dict(row) if row is not None else None
+
+    def get_version(self):
+        """Something that changes whenever a run completes; the latest
+        snapshot in a database without runs."""
+        c = self.__conn.cursor()
+        try:
+            version = tuple(c.execute('''
+                SELECT COUNT(1), MAX(completed_at) FROM runs
+                WHERE completed_at IS NOT NULL
+            ''').fetchone())
+            if version[0] > 0:
+                return version
+        except sqlite3.OperationalError:
+            pass
+        return tuple(c.execute(f"SELECT MAX(timestamp) FROM {'snapshots' if self.legacy else 'account_snapshots'}").fetchone())
+
+    def get_accounts_shard(self, worker, workers):
         c = self.__conn.cursor()
         r = c.execute('''
-            SELECT * FROM snapshots
-            WHERE address = ?
-            ORDER BY timestamp ASC
-        ''', (address,))
-        rows = r.fetchall()
-
-        def add_income(i, row):
-            row = dict(row)
-            last_state = rows and (i-1 >= 0) and rows[i-1] or None
-
-            if not last_state:
-                income = None
-            else:
-                # to calculate income:
-                #   today's balance - yesterday's balance +
-                #   yesterday's bond - today's bond +
-                #   today's pending rewards - yesterday's pending rewards -
-                #   today's pending commission - yesterday's pending commission -
-                #   net transaction flow since last snapshot
-                income = row['balance'] - last_state['balance'] + \
-                         row['bond'] - last_state['bond'] + \
-                         row['pending_commission'] - last_state['pending_commission'] + \
-                         row['pending_rewards'] - last_state['pending_rewards'] - \
-                         row['net_tx']
-
-            row['income'] = income
-            return row
-
-        return [add_income(i, row) for (i, row) in enumerate(rows)]
-
-
-# parse command line arguments
-parser = ArgumentParser(description="Generate CSV output for account(s) earnings")
-parser.add_argument('--db-path', required=True, help="path to sqlite3 database with daily report snapshots")
-parser.add_argument('--output-dir', default=join(dirname(__file__), 'csvs'), help="path to store csvs")
-parser.add_argument('--denom', nargs='?', default='uatom', help="the denomination of balances/shares/etc")
-args = parser.parse_args()
-
-
-try: mkdir(args.output_dir)
-except: pass
-print(f"Generating CSV outputs in {args.output_dir}...")
-
-db = Db(args.db_path)
-
-accounts = db.get_accounts()
-for address in accounts:
-    print(f"\t{address} ", end='')
-
-    lines = db.get_full_report(address)
-    print(f"({len(lines)} lines) ", end='')
-
-    with open(join(args.output_dir, f"{address}.csv"), 'w', newline='') as csvfile:
-        fields = [
-            'timestamp', 'height', 'balance', 'bond',
-            'pending_rewards', 'pending_commission', 'net_tx', 'income'
-        ]
-        writer = csv.DictWriter(csvfile, fieldnames=fields, extrasaction='ignore', quoting=csv.QUOTE_MINIMAL)
-        writer.writerow(OrderedDict([(field, sub('_', ' ', field).title()) for field in fields]))
-        writer.writerows(lines)
-
-    print("DONE")
-
-print(f"Generated {len(accounts)} CSV reports.")
+            SELECT address FROM accounts
+            WHERE rowid % ? = ?
+        ''', (workers, worker))
+        return list(map(lambda row: row['address'], c.fetchall()))
+
+    def stream_snapshots(self, worker, workers, exported=None):
+        """All snapshot rows for one shard of the accounts, ordered by
+        account then timestamp.
+
+        With `exported` ({address: (timestamp, id)}) only rows from the last
+        exported one onward are scanned; that row is included so income can
+        be computed for the next one."""
+        c = self.__conn.cursor()
+        if self.legacy:
+            query, shard = LEGACY_SNAPSHOTS_QUERY, 'address IN (SELECT address FROM accounts WHERE rowid % ? = ?)'
+        else:
+            query, shard = SNAPSHOTS_QUERY, 'account_id % ? = ?'
+        if exported is None:
+            return c.execute(query.format(join='', where=shard), (workers, worker))
+
+        c.execute('''
+            CREATE TEMP TABLE IF NOT EXISTS exported (
+                address TEXT PRIMARY KEY,
+                timestamp TIMESTAMP,
+                id INTEGER
+            )
+        ''')
+        c.execute('DELETE FROM temp.exported')
+        c.executemany('''
+            INSERT INTO temp.exported (address, timestamp, id)
+            VALUES (?, ?, ?)
+        ''', [(address, timestamp, id) for (address, (timestamp, id)) in exported.items()])
+        if self.legacy:
+            since = '''
+                exported.id IS NULL OR
+                snapshots.timestamp > exported.timestamp OR
+                (snapshots.timestamp = exported.timestamp AND snapshots.id >= exported.id)
+            '''
+        else:
+            # an account has one snapshot per timestamp
+            since = 'exported.timestamp IS NULL OR account_snapshots.timestamp >= exported.timestamp'
+        return c.execute(query.format(
+            join='LEFT JOIN temp.exported USING (address)',
+            where=f"{shard} AND ({since})"
+        ), (workers, worker))
+
+
+    def get_rollups(self, resolution):
+        c = self.__conn.cursor()
+        return c.execute('''
+            SELECT address, period, income, snapshots FROM income_rollups
+            WHERE resolution = ?
+            ORDER BY address ASC, period ASC
+        ''', (resolution,))
+
+    def get_network_rollups(self, resolution):
+        c = self.__conn.cursor()
+        return c.execute('''
+            SELECT period, income, snapshots FROM network_income_rollups
+            WHERE resolution = ?
+            ORDER BY period ASC
+        ''', (resolution,))
+
+
+class CsvReport:
+    def __init__(self, path, append=False, scale=None):
+        self.__scale = scale
+        self.__file = open(path, 'a' if append else 'w', newline='')
+        self.__writer = csv.DictWriter(self.__file, fieldnames=FIELDS, extrasaction='ignore', quoting=csv.QUOTE_MINIMAL)
+        if not append:
+            self.__writer.writerow(OrderedDict([(field, sub('_', ' ', field).title()) for field in FIELDS]))
+        self.lines = 0
+
+    def write(self, row):
+        row = dict(row)
+        if self.__scale is not None:
+            for field in AMOUNT_FIELDS:
+                row[field] = to_denom(row[field], self.__scale)
+        self.__writer.writerow(row)
+        self.lines += 1
+
+    def close(self):
+        self.__file.close()
+
+
+class Manifest:
+    """Last exported (timestamp, id) per account, kept in the output dir."""
+
+    def __init__(self, output_dir):
+        self.path = join(output_dir, '.manifest.json')
+        try:
+            with open(self.path, 'r') as f:
+                self.exported = {address: tuple(last) for (address, last) in json.load(f).items()}
+        except (OSError, ValueError):
+            self.exported = {}
+
+    def save(self):
+        with open(f"{self.path}.tmp", 'w') as f:
+            json.dump(self.exported, f, separators=(',', ':'))
+        replace(f"{self.path}.tmp", self.path)
+
+
+def export_summary(db_path, output_dir, resolution, scale=6):
+    """Write income per account and network-wide for each period,
+    straight from the rollups maintained by calculate_earnings.py."""
+    db = Db(db_path, scale)
+
+    for (name, rows, fields) in [
+        (f"summary-{resolution}.csv", db.get_rollups(resolution), ['address', 'period', 'income', 'snapshots']),
+        (f"network-{resolution}.csv", db.get_network_rollups(resolution), ['period', 'income', 'snapshots'])
+    ]:
+        with open(join(output_dir, name), 'w', newline='') as csvfile:
+            writer = csv.writer(csvfile, quoting=csv.QUOTE_MINIMAL)
+            writer.writerow([sub('_', ' ', field).title() for field in fields])
+            for row in rows:
+                row = dict(row)
+                if db.scale is not None:
+                    row['income'] = to_denom(row['income'], db.scale)
+                writer.writerow([row[field] for field in fields])
+        print(f"\t{name} DONE")
+
+
+def export_yields(db_path, output_dir, scale=6):
+    """Write the income and annualized yield of every account over all
+    its snapshots, and the network's income and median daily yield at
+    each snapshot time."""
+    db = Db(db_path, scale)
+    network = NetworkAggregates()
+
+    # NaN where there was no stake
+    def amount(value):
+        if value != value: return ''
+        return value if db.scale is None else to_denom(round(value), db.scale)
+
+    def ratio(value):
+        return '' if value != value else f"{value:.6f}"
+
+    name = 'yields.csv'
+    fields = ['address', 'snapshots', 'income', 'average_stake', 'annualized_yield']
+    with open(join(output_dir, name), 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile, quoting=csv.QUOTE_MINIMAL)
+        writer.writerow([sub('_', ' ', field).title() for field in fields])
+        for snapshots in Snapshots.batches(db.stream_snapshots(0, 1)):
+            network.add(snapshots)
+            for summary in snapshots.account_summaries():
+                writer.writerow([
+                    summary['address'],
+                    summary['snapshots'],
+                    amount(summary['income']),
+                    amount(summary['average_stake']),
+                    ratio(summary['annualized_yield'])
+                ])
+    print(f"\t{name} DONE")
+
+    name = 'network-yields.csv'
+    fields = ['timestamp', 'accounts', 'income', 'median_daily_yield']
+    with open(join(output_dir, name), 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile, quoting=csv.QUOTE_MINIMAL)
+        writer.writerow([sub('_', ' ', field).title() for field in fields])
+        for aggregate in network.by_snapshot():
+            writer.writerow([
+                aggregate['timestamp'],
+                aggregate['accounts'],
+                amount(aggregate['income']),
+                ratio(aggregate['median_daily_yield'])
+            ])
+    print(f"\t{name} DONE")
+
+
+def export(db_path, output_dir, worker, workers, exported=None, scale=6):
+    """Write the CSVs for one shard of the accounts. With `exported`, only
+    rows newer than the last exported one are appended to existing files.
+    Returns the number of accounts and their last exported rows."""
+    db = Db(db_path, scale)
+    incremental = exported is not None
+    last_exported = {}
+
+    def finish(address, report):
+        report.close()
+        print(f"\t{address} ({report.lines} lines) DONE")
+
+    # income is worked out for a batch of accounts at a time
+    for snapshots in Snapshots.batches(db.stream_snapshots(worker, workers, exported)):
+        for (address, rows) in snapshots.accounts():
+            report = None
+            for row in rows:
+                # the last exported row is only there as the base for income
+                if incremental and address in exported and exported[address][0] == str(row['timestamp']) and \
+                   (row['id'] is None or exported[address][1] == row['id']):
+                    continue
+
+                if report is None:
+                    path = join(output_dir, f"{address}.csv")
+                    report = CsvReport(path, append=incremental and address in exported and exists(path), scale=db.scale)
+                report.write(row)
+                last_exported[address] = (str(row['timestamp']), row['id'])
+
+            if report is not None:
+                finish(address, report)
+
+    # accounts without any snapshots still get a (header only) file
+    accounts = db.get_accounts_shard(worker, workers)
+    for address in accounts:
+        path = join(output_dir, f"{address}.csv")
+        if address not in last_exported and not (incremental and exists(path)):
+            finish(address, CsvReport(path))
+
+    return len(accounts), last_exported
+
+
+if __name__ == '__main__':
+    # parse command line arguments
+    parser = ArgumentParser(description="Generate CSV output for account(s) earnings")
+    parser.add_argument('--db-path', required=True, help="path to sqlite3 database with daily report snapshots")
+    parser.add_argument('--output-dir', default=join(dirname(__file__), 'csvs'), help="path to store csvs")
+    parser.add_argument('--denom', nargs='?', default='uatom', help="the denomination of balances/shares/etc")
+    parser.add_argument('--scale', nargs='?', default=6, type=int, help="scale factor to real world denom from chain denom")
+    parser.add_argument('--workers', default=1, type=int, help="number of processes writing csvs")
+    parser.add_argument('--incremental', action='store_true', help="only append rows added since the last export")
+    parser.add_argument('--summary', action='append', default=[], choices=['daily', 'monthly', 'yearly'], help="also write income summaries per period (can be repeated)")
+    parser.add_argument('--yields', action='store_true', help="also write the annualized yield of each account, and the network's median daily yield per snapshot")
+    args = parser.parse_args()
+
+
+    try: mkdir(args.output_dir)
+    except: pass
+    print(f"Generating CSV outputs in {args.output_dir}...")
+
+    manifest = Manifest(args.output_dir)
+    exported = manifest.exported if args.incremental else None
+
+    # each worker streams and writes its own share of the accounts
+    if args.workers > 1:
+        with Pool(args.workers) as pool:
+            results = pool.starmap(export, [
+                (args.db_path, args.output_dir, worker, args.workers, exported, args.scale)
+                for worker in range(args.workers)
+            ])
+    else:
+        results = [export(args.db_path, args.output_dir, 0, 1, exported, args.scale)]
+
+    if not args.incremental:
+        manifest.exported = {}
+    for count, last_exported in results:
+        manifest.exported.update(last_exported)
+    manifest.save()
+
+    print(f"Generated {sum(map(lambda result: result[0], results))} CSV reports.")
+
+    for resolution in args.summary:
+        export_summary(args.db_path, args.output_dir, resolution, args.scale)
+
+    if args.yields:
+        export_yields(args.db_path, args.output_dir, args.scale)
@@ -1,12 +1,29 @@
 #!/usr/bin/env bash
 
 set -e
-trap cleanup EXIT
 
 WORKING_DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null 2>&1 && pwd )"
 
 DENOM=${DENOM:-uatom}
 
+# how many accounts to fetch from the LCD in parallel
+CONCURRENCY=${CONCURRENCY:-8}
+
+# how many snapshots to report on at once, each with its own
+# clone, node and LCD
+PARALLEL_SNAPSHOTS=${PARALLEL_SNAPSHOTS:-2}
+
+# set to 1 to carry balance and bond forward for inactive accounts
+# instead of re-querying them for every account
+INCREMENTAL=${INCREMENTAL:-0}
+REPORT_FLAGS=""
+if [ "$INCREMENTAL" = "1" ]; then
+  REPORT_FLAGS="--incremental"
+fi
+if [ ! -z $RESET_DATA ]; then
+  REPORT_FLAGS="$REPORT_FLAGS --reset-data"
+fi
+
 # the binaries to use
 NODE_BINARY=${NODE_BINARY:-gaiad}
 CLI_BINARY=${CLI_BINARY:-gaiacli}
@@ -18,115 +35,11 @@ if [ -z $DATA_DIR ]; then
   exit 1
 fi
 
-# determine ZFS filesystem in use
-ZFS_FS=$(zfs list | grep `eval echo $DATA_DIR` | awk '{print $1;}')
-ZFS_POOL=$(zpool list -Hp | awk '{print $1;}' | while read pool; do if [[ "$ZFS_FS" =~ ^$pool ]]; then echo $pool; break; fi; done)
-# ensure any existing tmp clone is destroyed
-(sudo zfs destroy $ZFS_POOL/tmp > /dev/null 2>&1 || exit 0)
-
-# lock down p2p port so no further syncing can take place
-echo -n "Locking down firewall... "
-sudo ufw deny to any port 26656 > /dev/null 2>&1
-sudo ufw deny out to any port 26656 > /dev/null 2>&1
-sleep 3
-echo "DONE"
-
-NODE_PID=0
-LCD_PID=0
-start_node() {
-  home=${1:-/$ZFS_POOL/tmp}
-  echo -n "Starting node... "
-  $NODE_BINARY start --home "$home" > ~/node.log 2>&1 &
-  NODE_PID=$!
-  sleep 1
-  echo "OK (pid: $NODE_PID)"
-}
-start_lcd() {
-  home=${1:-/$ZFS_POOL/tmp}
-  echo -n "Starting LCD... "
-  $CLI_BINARY rest-server --laddr tcp://0.0.0.0:1317 --home "$home" --trust-node=true > ~/lcd.log 2>&1 &
-  LCD_PID=$!
-  sleep 1
-  echo "OK (pid: $LCD_PID)"
-}
-stop_node() {
-  kill -SIGINT $NODE_PID
-}
-stop_lcd() {
-  kill -SIGINT $LCD_PID
-}
-
-clone_snapshot() {
-  echo "Switching to snapshot: $snapshot"
-  sudo zfs clone "$1" "$ZFS_POOL/tmp"
-  sudo chown -R $USER:$USER "/$ZFS_POOL/tmp"
-}
-discard_clone() {
-  sudo zfs destroy "$ZFS_POOL/tmp"
-}
-
-cleanup() {
-  stop_lcd
-  stop_node
-}
-
-echo "Determining network..."
-start_node "$DATA_DIR"
-sleep 2
-NETWORK_NAME=$(curl -s localhost:26657/status | jq -r '.result.node_info.network')
-if [[ -z $NETWORK_NAME || $NETWORK_NAME == "" ]]; then
-  echo "Unable to determine network."
-  exit 1
-fi
-echo "Network: $NETWORK_NAME"
-stop_node
-echo "Database: $WORKING_DIR/${NETWORK_NAME}.db"
-echo "Log: $WORKING_DIR/${NETWORK_NAME}-reports.log"
-
-sleep 2
-
-if [ ! -z $RESET_DATA ]; then
-  echo "Resetting database..."
-  (rm "$WORKING_DIR/${NETWORK_NAME}.db" > /dev/null 2>&1 || exit 0)
-fi
-
-echo
-
-zfs list -Hp -t snapshot -o name | grep $ZFS_FS | while read snapshot; do
-  # determine if we need to skip this snapshot because we already
-  # have data for it
-  latest_report=$(sqlite3 "$WORKING_DIR/${NETWORK_NAME}.db" "SELECT timestamp FROM snapshots ORDER BY timestamp DESC LIMIT 1;")
-  latest_date=$(date -d "$latest_report" +%Y-%m-%d)
-  IFS='@'
-  read -ra snapshot_date <<< "$snapshot"
-  snapshot_date=${snapshot_date[1]}
-  if ! [[ "$snapshot_date" > "$latest_date" ]]; then
-    echo "Skipping $snapshot_date"
-    continue
-  fi
-
-  clone_snapshot "$snapshot"
-  sleep 3
-
-  start_node
-  start_lcd
-  sleep 5
-
-  $PYTHON_BINARY -u $WORKING_DIR/calculate_earnings.py \
-    --denom $DENOM \
-    --db-path $WORKING_DIR/${NETWORK_NAME}.db \
-    --log-path $WORKING_DIR/${NETWORK_NAME}-reports.log
-
-  stop_lcd
-  stop_node
-  sleep 2
-
-  discard_clone
-  sleep 3
-  echo
-done
-
-$PYTHON_BINARY -u $WORKING_DIR/output_csvs.py \
+$PYTHON_BINARY -u $WORKING_DIR/report_on_snapshots.py \
+  --data-dir `eval echo $DATA_DIR` \
   --denom $DENOM \
-  --db-path $WORKING_DIR/${NETWORK_NAME}.db \
-  --output-dir $WORKING_DIR/csvs
+  --concurrency $CONCURRENCY \
+  --parallel $PARALLEL_SNAPSHOTS \
+  --node-binary $NODE_BINARY \
+  --cli-binary $CLI_BINARY \
+  $REPORT_FLAGS
@@ -0,0 +1,278 @@
+import json
+import time
+import signal
+import subprocess
+
+from sys import executable
+from argparse import ArgumentParser
+from importlib import import_module
+from os import remove, makedirs, getenv
+from os.path import dirname, join, exists, expanduser
+from glob import glob
+from queue import Queue
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.request import urlopen
+
+from genesis import JsonStream, read_document
+from merge_shards import Db
+
+
+class Provider:
+    """Provides the nodes to report on, one per snapshot.
+
+    Snapshots are handed out to `slots`, numbered from 0; a slot is only
+    used for one snapshot at a time, so it can decide ports and paths."""
+
+    def __init__(self, args):
+        self.args = args
+
+    def network(self):
+        """The chain id, which names the database."""
+        raise NotImplementedError
+
+    def prepare(self):
+        """Called once before any snapshot is started."""
+        pass
+
+    def snapshots(self):
+        """(name, date) of every snapshot, oldest first."""
+        raise NotImplementedError
+
+    def start(self, snapshot, slot):
+        """Start the RPC and LCD for a snapshot, returning their URLs.
+        They don't need to be ready yet."""
+        raise NotImplementedError
+
+    def stop(self, slot):
+        """Stop whatever `start` started for the slot, and clean up."""
+        raise NotImplementedError
+
+
+class ZfsProvider(Provider):
+    """Nodes run from clones of the ZFS snapshots of DATA_DIR, as made by
+    generate-snapshots.bash; each slot has its own clone and ports."""
+
+    def __init__(self, args):
+        super().__init__(args)
+        self.data_dir = args.data_dir.rstrip('/')
+        self.processes = {}
+
+        # the filesystem mounted at DATA_DIR, and its pool
+        for line in subprocess.check_output(['zfs', 'list', '-H', '-o', 'name,mountpoint'], universal_newlines=True).splitlines():
+            name, mountpoint = line.split('\t')
+            if mountpoint == self.data_dir:
+                self.fs = name
+                break
+        else:
+            raise ValueError(f"{self.data_dir} is not a ZFS filesystem")
+        self.pool = self.fs.split('/')[0]
+
+    def network(self):
+        with open(join(self.data_dir, 'config', 'genesis.json'), 'rb') as f:
+            for kind, value in read_document(JsonStream(f), {('chain_id',): 'chain_id'}):
+                return value
+
+    def prepare(self):
+        # lock down p2p port so no further syncing can take place
+        print("Locking down firewall... ")
+        subprocess.run(['sudo', 'ufw', 'deny', 'to', 'any', 'port', '26656'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        subprocess.run(['sudo', 'ufw', 'deny', 'out', 'to', 'any', 'port', '26656'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        # ensure any existing clones are destroyed
+        for slot in range(self.args.parallel):
+            subprocess.run(['sudo', 'zfs', 'destroy', self.clone(slot)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def snapshots(self):
+        names = subprocess.check_output(['zfs', 'list', '-Hp', '-t', 'snapshot', '-o', 'name'], universal_newlines=True).split()
+        return [(name, name.split('@')[1]) for name in names if name.startswith(f"{self.fs}@")]
+
+    def clone(self, slot):
+        return f"{self.pool}/tmp" if slot == 0 else f"{self.pool}/tmp-{slot}"
+
+    def start(self, snapshot, slot):
+        clone = self.clone(slot)
+        home = f"/{clone}"
+        subprocess.run(['sudo', 'zfs', 'clone', snapshot, clone], check=True)
+        subprocess.run(['sudo', 'chown', '-R', f"{getenv('USER')}:{getenv('USER')}", home], check=True)
+
+        # slot 0 uses the default ports
+        p2p_port, rpc_port, lcd_port = 26656 + slot * 10, 26657 + slot * 10, 1317 + slot * 10
+        log_dir = expanduser('~')
+        node = subprocess.Popen(
+            [self.args.node_binary, 'start', '--home', home,
+             '--p2p.laddr', f"tcp://0.0.0.0:{p2p_port}",
+             '--rpc.laddr', f"tcp://127.0.0.1:{rpc_port}"],
+            stdout=open(join(log_dir, f"node-{slot}.log"), 'w'), stderr=subprocess.STDOUT
+        )
+        lcd = subprocess.Popen(
+            [self.args.cli_binary, 'rest-server', '--laddr', f"tcp://0.0.0.0:{lcd_port}",
+             '--node', f"tcp://127.0.0.1:{rpc_port}", '--home', home, '--trust-node=true'],
+            stdout=open(join(log_dir, f"lcd-{slot}.log"), 'w'), stderr=subprocess.STDOUT
+        )
+        self.processes[slot] = [lcd, node]
+
+        return f"http://127.0.0.1:{rpc_port}", f"http://127.0.0.1:{lcd_port}"
+
+    def stop(self, slot):
+        for process in self.processes.pop(slot, []):
+            process.send_signal(signal.SIGINT)
+            try:
+                process.wait(timeout=60)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+
+        # the clone can stay busy for a moment after the node exits
+        for attempt in range(10):
+            if subprocess.run(['sudo', 'zfs', 'destroy', self.clone(slot)], stderr=subprocess.DEVNULL).returncode == 0:
+                return
+            time.sleep(1)
+        raise RuntimeError(f"Could not destroy {self.clone(slot)}")
+
+
+def wait_ready(url, timeout):
+    """Poll `url` until it answers successfully."""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with urlopen(url, timeout=5) as response:
+                json.loads(response.read().decode('utf-8'))
+                return
+        except (OSError, ValueError):
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"{url} was not ready after {timeout}s")
+            time.sleep(0.25)
+
+
+def load_provider(path):
+    module, name = path.split(':')
+    return getattr(import_module(module), name)
+
+
+if __name__ == '__main__':
+    # parse command line arguments
+    parser = ArgumentParser(description="Run the reports for every snapshot, several at a time")
+    parser.add_argument('--data-dir', help="the --home of the node, on the ZFS filesystem holding the snapshots")
+    parser.add_argument('--provider', default='report_on_snapshots:ZfsProvider', help="module:Class providing the nodes for each snapshot")
+    parser.add_argument('--parallel', default=2, type=int, help="number of snapshots to report on at once")
+    parser.add_argument('--work-dir', default=join(dirname(__file__), 'work'), help="path to keep the databases of snapshots in progress")
+    parser.add_argument('--denom', default='uatom', help="the denomination of balances/shares/etc")
+    parser.add_argument('--scale', default=6, type=int, help="scale factor to real world denom from chain denom")
+    parser.add_argument('--concurrency', default=8, type=int, help="number of accounts to fetch from each LCD in parallel")
+    parser.add_argument('--incremental', action='store_true', help="carry balance and bond forward for inactive accounts")
+    parser.add_argument('--node-binary', default='gaiad')
+    parser.add_argument('--cli-binary', default='gaiacli')
+    parser.add_argument('--ready-timeout', default=600, type=int, help="seconds to wait for a node and LCD to answer")
+    parser.add_argument('--reset-data', action='store_true', help="start the database over")
+    parser.add_argument('--no-csvs', action='store_true', help="don't write the CSVs at the end")
+    args = parser.parse_args()
+
+
+    provider = load_provider(args.provider)(args)
+    network = provider.network()
+    db_path = join(dirname(__file__), f"{network}.db")
+    log_path = join(dirname(__file__), f"{network}-reports.log")
+    print(f"Network: {network}")
+    print(f"Database: {db_path}")
+    print(f"Log: {log_path}")
+
+    if args.reset_data:
+        print("Resetting database...")
+        # snapshots left in progress were seeded from the old database,
+        # so they are started over too
+        for path in [db_path] + glob(join(args.work_dir, '*.db')) + glob(join(args.work_dir, '*.log')):
+            for suffix in ('', '-wal', '-shm'):
+                if exists(f"{path}{suffix}"):
+                    remove(f"{path}{suffix}")
+
+    provider.prepare()
+    makedirs(args.work_dir, exist_ok=True)
+    db = Db(db_path, args.scale)
+
+    # snapshots before the latest report are done already; the
+    # latest one is only done if its run completed
+    latest_date = db.get_latest_report_date()
+    snapshots = []
+    for (snapshot, date) in provider.snapshots():
+        if latest_date is not None and (date < latest_date or (date == latest_date and db.has_completed_run(date))):
+            print(f"Skipping {date}")
+        else:
+            snapshots.append((snapshot, date))
+
+    slots = Queue()
+    for slot in range(args.parallel):
+        slots.put(slot)
+
+    def run(snapshot, date, path):
+        # each snapshot runs in whichever slot is free
+        slot = slots.get()
+        try:
+            print(f"Switching to snapshot: {snapshot} (slot {slot})")
+            rpc, lcd = provider.start(snapshot, slot)
+            wait_ready(f"{rpc}/status", args.ready_timeout)
+            wait_ready(f"{lcd}/node_info", args.ready_timeout)
+
+            with open(join(args.work_dir, f"{date}.log"), 'a') as output:
+                subprocess.run(
+                    [executable, '-u', join(dirname(__file__), 'calculate_earnings.py'),
+                     '--denom', args.denom,
+                     '--scale', str(args.scale),
+                     '--concurrency', str(args.concurrency),
+                     '--db-path', path,
+                     '--log-path', log_path,
+                     '--rpc', rpc,
+                     '--lcd', lcd] + (['--incremental'] if args.incremental else []),
+                    stdout=output, stderr=subprocess.STDOUT, check=True
+                )
+        finally:
+            provider.stop(slot)
+            slots.put(slot)
+
+    def write(snapshot, date, path, future):
+        # the main thread is the only one writing to the database, and
+        # snapshots are merged in order so each one follows the last
+        future.result()
+        count = db.merge(path)
+        # the snapshots merged are recorded with them, so if this is cut
+        # short, the next merge still works out their net flow and rollups,
+        # which are written in one go with the run they complete
+        db.recompute_net_tx()
+        db.append_rollups()
+        db.complete_runs([path])
+        db.commit()
+        for suffix in ('', '-wal', '-shm'):
+            if exists(f"{path}{suffix}"):
+                remove(f"{path}{suffix}")
+        print(f"{date}: {count} snapshots DONE")
+
+    # a snapshot's database starts from everything merged so far; one
+    # left by an interrupted run is picked up where it stopped
+    with ThreadPoolExecutor(max_workers=args.parallel) as executor:
+        in_flight = deque()
+        for (snapshot, date) in snapshots:
+            path = join(args.work_dir, f"{date}.db")
+            if not exists(path):
+                db.seed(path)
+            in_flight.append((snapshot, date, path, executor.submit(run, snapshot, date, path)))
+
+            if len(in_flight) >= args.parallel:
+                write(*in_flight.popleft())
+
+        while in_flight:
+            write(*in_flight.popleft())
+
+    if not args.no_csvs:
+        subprocess.run(
+            [executable, '-u', join(dirname(__file__), 'output_csvs.py'),
+             '--denom', args.denom,
+             '--scale', str(args.scale),
+             '--db-path', db_path,
+             '--output-dir', join(dirname(__file__), 'csvs'),
+             '--incremental',
+             '--summary', 'daily',
+             '--summary', 'monthly',
+             '--summary', 'yearly',
+             '--yields'],
+            check=True
+        )
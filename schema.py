@@ -0,0 +1,327 @@
+from shutil import copyfile
+from os.path import exists
+
+
+# the income of a snapshot is the change in each of these since the
+# snapshot before it, less the net transaction flow in between:
+#
+#   today's balance - yesterday's balance +
+#   today's bond - yesterday's bond +
+#   today's pending commission - yesterday's pending commission +
+#   today's pending rewards - yesterday's pending rewards -
+#   net transaction flow since last snapshot
+#
+# calculate_earnings.income, analytics.Snapshots.income and the rollup SQL
+# (income_sql) all work it out from these, added up in this order so floats
+# in the old layout come out the same everywhere
+INCOME_TERMS = ('balance', 'bond', 'pending_commission', 'pending_rewards')
+
+
+def income_sql(current, previous):
+    """SQL for the income of a snapshot, with `current` and `previous`
+    formatting a column name into its value in the snapshot and in the
+    one before it."""
+    return ' + '.join(f"{current.format(name)} - {previous.format(name)}" for name in INCOME_TERMS) + \
+           f" - {current.format('net_tx')}"
+
+
+def snapshot_income_sql(where='1'):
+    """SQL for the address, timestamp and income of every snapshot `where`
+    selects (as `n`) that has one before it (as `p`) to measure from.
+
+    The snapshot before is looked up with a subquery rather than LAG(), so
+    it runs on the SQLite of Ubuntu 18.04 (3.22)."""
+    return f'''
+        SELECT * FROM (
+            SELECT accounts.address, n.timestamp, {income_sql('n.{}', 'p.{}')} AS income
+            FROM account_snapshots n
+            JOIN account_snapshots p ON p.account_id = n.account_id AND p.timestamp = (
+                SELECT MAX(timestamp) FROM account_snapshots
+                WHERE account_id = n.account_id AND timestamp < n.timestamp
+            )
+            JOIN accounts ON accounts.id = n.account_id
+            WHERE {where}
+        )
+        WHERE income IS NOT NULL
+    '''
+
+
+def add_rollups(conn, rollups):
+    """Add (address, resolution, period, income, snapshots) rows to the
+    income rollups of their accounts and of the network.
+
+    This is an upsert, written as an insert and an update, as
+    ON CONFLICT ... DO UPDATE needs SQLite 3.24."""
+    accounts, network = {}, {}
+    for (address, resolution, period, income, snapshots) in rollups:
+        total = accounts.get((address, resolution, period), (0, 0))
+        accounts[(address, resolution, period)] = (total[0] + income, total[1] + snapshots)
+        total = network.get((resolution, period), (0, 0))
+        network[(resolution, period)] = (total[0] + income, total[1] + snapshots)
+
+    conn.executemany('''
+        INSERT OR IGNORE INTO income_rollups (address, resolution, period, income, snapshots)
+        VALUES (?, ?, ?, 0, 0)
+    ''', accounts.keys())
+    conn.executemany('''
+        UPDATE income_rollups SET income = income + ?, snapshots = snapshots + ?
+        WHERE address = ? AND resolution = ? AND period = ?
+    ''', [totals + key for (key, totals) in accounts.items()])
+    conn.executemany('''
+        INSERT OR IGNORE INTO network_income_rollups (resolution, period, income, snapshots)
+        VALUES (?, ?, 0, 0)
+    ''', network.keys())
+    conn.executemany('''
+        UPDATE network_income_rollups SET income = income + ?, snapshots = snapshots + ?
+        WHERE resolution = ? AND period = ?
+    ''', [totals + key for (key, totals) in network.items()])
+
+
+# income rollup resolutions, and the strftime format of their periods
+ROLLUPS = {
+    'daily': '%Y-%m-%d',
+    'monthly': '%Y-%m',
+    'yearly': '%Y'
+}
+
+
+def table_columns(conn, table):
+    return {row[1]: row[2] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+
+def init_schema(conn, scale):
+    """Create the tables of a report database, migrating one in the old
+    layout (a `snapshots` table of scaled REAL amounts) along the way.
+
+    Amounts are kept in integer base units of the chain denom; `scale` is
+    only needed for converting amounts from the old layout."""
+    # an old layout is converted in place, so the file is copied first
+    if needs_conversion(conn):
+        backup(conn, scale)
+
+    # Python's sqlite3 doesn't start a transaction for DDL, so a conversion
+    # cut short would leave tables half renamed; everything is done in
+    # one explicit transaction instead
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None
+    try:
+        conn.execute('BEGIN')
+        try:
+            create_tables(conn, scale)
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+    finally:
+        conn.isolation_level = isolation_level
+
+
+def needs_conversion(conn):
+    """Whether any of the tables are in the old layout."""
+    columns = table_columns(conn, 'accounts')
+    return (columns and 'id' not in columns) or \
+           bool(table_columns(conn, 'snapshots')) or \
+           table_columns(conn, 'transactions').get('amount') == 'REAL'
+
+
+def backup(conn, scale):
+    """Copy the database file to `<path>.bak`, unless there is one already
+    (from a conversion that didn't go through)."""
+    path = [row[2] for row in conn.execute('PRAGMA database_list') if row[1] == 'main'][0]
+    if not path: return
+    print(f"Converting {path} from the old layout, with amounts scaled by 10^{scale} (--scale)")
+    if exists(f"{path}.bak"):
+        print(f"Keeping the existing backup {path}.bak")
+        return
+    # anything still in the write-ahead log goes into the file first
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    copyfile(path, f"{path}.bak")
+    print(f"Backed it up to {path}.bak")
+
+
+def create_tables(conn, scale):
+    # accounts are referred to by id; databases from before the
+    # id (or the valoper) column existed are rebuilt with it
+    columns = table_columns(conn, 'accounts')
+    if columns and 'id' not in columns:
+        conn.execute('ALTER TABLE accounts RENAME TO legacy_accounts')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS accounts (
+            id INTEGER PRIMARY KEY,
+            address TEXT NOT NULL UNIQUE,
+            valoper TEXT
+        )
+    ''')
+    if columns and 'id' not in columns:
+        conn.execute(f'''
+            INSERT INTO accounts (address, valoper)
+            SELECT address, {'valoper' if 'valoper' in columns else 'NULL'} FROM legacy_accounts
+            ORDER BY rowid ASC
+        ''')
+        conn.execute('DROP TABLE legacy_accounts')
+
+    # one row per account and snapshot, stored in account order
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS account_snapshots (
+            account_id INTEGER NOT NULL,
+            timestamp TIMESTAMP NOT NULL,
+            height INTEGER NOT NULL,
+            balance INTEGER,
+            bond INTEGER,
+            pending_rewards INTEGER,
+            pending_commission INTEGER,
+            net_tx INTEGER,
+            PRIMARY KEY (account_id, timestamp)
+        ) WITHOUT ROWID
+    ''')
+    if table_columns(conn, 'snapshots'):
+        conn.execute('''
+            INSERT OR IGNORE INTO accounts (address)
+            SELECT DISTINCT address FROM snapshots
+        ''')
+        # the old amounts were already rounded, so scaling
+        # them back up gives whole base units
+        conn.execute('''
+            INSERT OR IGNORE INTO account_snapshots (account_id, timestamp, height, balance, bond,
+                                                     pending_rewards, pending_commission, net_tx)
+            SELECT accounts.id, timestamp, CAST(height AS INTEGER),
+                   CAST(ROUND(balance * :unit) AS INTEGER),
+                   CAST(ROUND(bond * :unit) AS INTEGER),
+                   CAST(ROUND(pending_rewards * :unit) AS INTEGER),
+                   CAST(ROUND(pending_commission * :unit) AS INTEGER),
+                   CAST(ROUND(net_tx * :unit) AS INTEGER)
+            FROM snapshots
+            JOIN accounts USING (address)
+            ORDER BY snapshots.id ASC
+        ''', {'unit': 10 ** scale})
+        conn.execute('DROP TABLE snapshots')
+        # rolled up again from the migrated snapshots below
+        conn.execute('DROP TABLE IF EXISTS income_rollups')
+        conn.execute('DROP TABLE IF EXISTS network_income_rollups')
+
+    # one row per MsgSend, the fee is carried by the first
+    # MsgSend of each transaction so it is only counted once
+    columns = table_columns(conn, 'transactions')
+    if columns.get('amount') == 'REAL':
+        conn.execute('ALTER TABLE transactions RENAME TO legacy_transactions')
+        conn.execute('DROP INDEX IF EXISTS transactions_sender')
+        conn.execute('DROP INDEX IF EXISTS transactions_recipient')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS transactions (
+            hash TEXT,
+            msg_index INTEGER,
+            height INTEGER,
+            timestamp TIMESTAMP,
+            sender TEXT,
+            recipient TEXT,
+            amount INTEGER,
+            fee INTEGER,
+            PRIMARY KEY (hash, msg_index)
+        )
+    ''')
+    if columns.get('amount') == 'REAL':
+        conn.execute('''
+            INSERT INTO transactions
+            SELECT hash, msg_index, height, timestamp, sender, recipient,
+                   CAST(ROUND(amount * :unit) AS INTEGER),
+                   CAST(ROUND(fee * :unit) AS INTEGER)
+            FROM legacy_transactions
+        ''', {'unit': 10 ** scale})
+        conn.execute('DROP TABLE legacy_transactions')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS transactions_sender
+        ON transactions (sender, timestamp)
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS transactions_recipient
+        ON transactions (recipient, timestamp)
+    ''')
+
+    # every account each indexed message involves, whatever its type
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS activity (
+            hash TEXT,
+            msg_index INTEGER,
+            address TEXT,
+            type TEXT,
+            height INTEGER,
+            timestamp TIMESTAMP,
+            PRIMARY KEY (hash, msg_index, address)
+        )
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS activity_address
+        ON activity (address, timestamp)
+    ''')
+    # databases from before the rollups existed have them backfilled
+    # below; ones that only lack some are caught up by whatever wrote
+    # the snapshots
+    backfill = not table_columns(conn, 'income_rollups')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS income_rollups (
+            address TEXT,
+            resolution TEXT,
+            period TEXT,
+            income INTEGER,
+            snapshots INTEGER,
+            PRIMARY KEY (address, resolution, period)
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS network_income_rollups (
+            resolution TEXT,
+            period TEXT,
+            income INTEGER,
+            snapshots INTEGER,
+            PRIMARY KEY (resolution, period)
+        )
+    ''')
+    if backfill:
+        backfill_rollups(conn)
+        conn.execute('''
+            INSERT INTO network_income_rollups (resolution, period, income, snapshots)
+            SELECT resolution, period, SUM(income), SUM(snapshots)
+            FROM income_rollups
+            GROUP BY resolution, period
+        ''')
+    # a run is only complete once every account has its report
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS runs (
+            chain TEXT,
+            height TEXT,
+            timestamp TIMESTAMP,
+            completed_at TIMESTAMP,
+            PRIMARY KEY (chain, height)
+        )
+    ''')
+    # accounts a completed run has no report for, as they still
+    # couldn't be retrieved after being tried again
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS failed_accounts (
+            chain TEXT,
+            height TEXT,
+            address TEXT,
+            PRIMARY KEY (chain, height, address)
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS checkpoints (
+            chain TEXT,
+            name TEXT,
+            page INTEGER,
+            height INTEGER,
+            PRIMARY KEY (chain, name)
+        )
+    ''')
+
+
+def backfill_rollups(conn, where='1'):
+    """Roll up the income of every snapshot (of the accounts `where` selects,
+    as `n`)."""
+    for (resolution, period_format) in ROLLUPS.items():
+        conn.execute(f'''
+            INSERT INTO income_rollups (address, resolution, period, income, snapshots)
+            SELECT address, ?, strftime(?, timestamp) AS period, SUM(income), COUNT(1)
+            FROM ({snapshot_income_sql(where)})
+            GROUP BY address, period
+        ''', (resolution, period_format))
@@ -0,0 +1,211 @@
+import json
+import sqlite3
+import time
+import hashlib
+import threading
+import traceback
+
+from argparse import ArgumentParser
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qsl, urlencode, unquote
+
+from lru import LruCache
+from schema import ROLLUPS
+from output_csvs import Db, FIELDS, AMOUNT_FIELDS, to_denom
+
+
+class NotFound(Exception):
+    pass
+
+
+class BadRequest(Exception):
+    pass
+
+
+class Service:
+    """JSON responses over a report database, cached until the next run
+    completes. Only ever reads the database."""
+
+    def __init__(self, db_path, scale=6, cache_size=10000, refresh=1):
+        self.db_path = db_path
+        self.scale = scale
+        self.refresh_seconds = refresh
+        self.cache = LruCache(cache_size)
+        self.__version = None
+        self.__checked = None
+        self.__lock = threading.Lock()
+        self.__local = threading.local()
+
+    def db(self):
+        # sqlite connections can't be shared between threads
+        if not hasattr(self.__local, 'db'):
+            self.__local.db = Db(self.db_path, self.scale)
+        return self.__local.db
+
+    def refresh(self):
+        """Empty the cache if a run has completed since the last check,
+        checking at most once every `refresh_seconds`."""
+        now = time.monotonic()
+        with self.__lock:
+            if self.__checked is not None and now - self.__checked < self.refresh_seconds:
+                return
+            self.__checked = now
+        version = self.db().get_version()
+        with self.__lock:
+            if version != self.__version:
+                self.__version = version
+                self.cache.clear()
+
+    def get(self, path, query):
+        """(status, body, etag) of a request."""
+        key = f"{path}?{urlencode(sorted(query.items()))}"
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+
+        try:
+            status, result = 200, self.route(path, query)
+        except NotFound as e:
+            status, result = 404, {'error': str(e)}
+        except BadRequest as e:
+            status, result = 400, {'error': str(e)}
+
+        body = json.dumps(result, separators=(',', ':'), default=str).encode('utf-8')
+        response = (status, body, f'"{hashlib.sha1(body).hexdigest()}"')
+        if status == 200:
+            self.cache.put(key, response)
+        return response
+
+    def route(self, path, query):
+        parts = [unquote(part) for part in path.strip('/').split('/')]
+        if parts == ['status']:
+            return self.status()
+        if len(parts) == 2 and parts[0] == 'accounts':
+            return self.snapshots(parts[1], query.get('from'), query.get('to'))
+        if len(parts) == 3 and parts[0] == 'accounts' and parts[2] == 'income':
+            return self.income(parts[1], self.resolution(query), query.get('from'), query.get('to'))
+        if parts == ['network']:
+            return self.network(self.resolution(query), query.get('from'), query.get('to'))
+        raise NotFound(f"No such resource: {path}")
+
+    def resolution(self, query):
+        resolution = query.get('resolution', 'daily')
+        if resolution not in ROLLUPS:
+            raise BadRequest(f"resolution must be one of: {', '.join(ROLLUPS)}")
+        return resolution
+
+    def amount(self, value):
+        # exact decimal strings, except in the old layout
+        return value if self.db().scale is None else to_denom(value, self.db().scale)
+
+    def status(self):
+        return {'latest_run': self.db().get_latest_run(), 'accounts': len(self.db().get_accounts())}
+
+    def report(self, address):
+        report = self.db().get_full_report(address)
+        if len(report) == 0:
+            raise NotFound(f"No snapshots for {address}")
+        return report
+
+    def snapshots(self, address, start=None, end=None):
+        """Every snapshot of an account with its income, from `start` to
+        `end` (dates or timestamps, inclusive)."""
+        return {
+            'address': address,
+            'snapshots': [
+                {field: self.amount(row[field]) if field in AMOUNT_FIELDS else row[field] for field in FIELDS}
+                for row in self.report(address) if in_range(str(row['timestamp']), start, end)
+            ]
+        }
+
+    def income(self, address, resolution, start=None, end=None):
+        """Income of an account per period, worked out like the CSVs'."""
+        periods = OrderedDict()
+        for row in self.report(address):
+            # the first snapshot is only the base for the next one's income
+            if row['income'] is None: continue
+            period = row['timestamp'].strftime(ROLLUPS[resolution])
+            income, snapshots = periods.get(period, (0, 0))
+            periods[period] = (income + row['income'], snapshots + 1)
+        return {
+            'address': address,
+            'resolution': resolution,
+            'periods': [
+                {'period': period, 'income': self.amount(income), 'snapshots': snapshots}
+                for (period, (income, snapshots)) in periods.items() if in_range(period, start, end)
+            ]
+        }
+
+    def network(self, resolution, start=None, end=None):
+        """Income across every account per period, from the rollups."""
+        try:
+            rows = self.db().get_network_rollups(resolution).fetchall()
+        except sqlite3.OperationalError:
+            raise NotFound("No income rollups in this database")
+        return {
+            'resolution': resolution,
+            'periods': [
+                {'period': row['period'], 'income': self.amount(row['income']), 'snapshots': row['snapshots']}
+                for row in rows if in_range(row['period'], start, end)
+            ]
+        }
+
+
+def in_range(value, start, end):
+    # compared as text, so `end` 2020-01 takes in the whole of January
+    return (start is None or value >= start) and (end is None or value[:len(end)] <= end)
+
+
+def make_handler(service):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            parts = urlsplit(self.path)
+            try:
+                service.refresh()
+                status, body, etag = service.get(parts.path, dict(parse_qsl(parts.query)))
+            except Exception:
+                traceback.print_exc()
+                status, body, etag = 500, b'{"error":"internal error"}', None
+
+            tags = [tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')]
+            if status == 200 and ('*' in tags or etag in tags or f"W/{etag}" in tags):
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            if etag is not None:
+                self.send_header('ETag', etag)
+                self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+            self.wfile.write(body)
+
+    return Handler
+
+
+if __name__ == '__main__':
+    # parse command line arguments
+    parser = ArgumentParser(description="Serve snapshots and income from a report database as JSON")
+    parser.add_argument('--db-path', required=True, help="path to sqlite3 database with daily report snapshots")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', default=8080, type=int)
+    parser.add_argument('--scale', default=6, type=int, help="scale factor to real world denom from chain denom")
+    parser.add_argument('--cache-size', default=10000, type=int, help="number of responses to keep in memory")
+    parser.add_argument('--refresh', default=1, type=float, help="seconds between checks for a newly completed run")
+    args = parser.parse_args()
+
+
+    service = Service(args.db_path, args.scale, args.cache_size, args.refresh)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(service))
+    server.daemon_threads = True
+    print(f"Serving {args.db_path} on http://{args.host}:{args.port}", flush=True)
+    server.serve_forever()
@@ -0,0 +1,173 @@
+import json
+import bech32
+
+from sys import exit
+from decimal import Decimal
+from argparse import ArgumentParser
+
+from genesis import JsonStream, open_genesis, read_document
+
+
+# the parts of an exported state (`gaiad export`) needed for a report
+EXPORT_PATHS = {
+    ('chain_id',): 'chain_id',
+    ('app_state', 'accounts', None): 'account',
+    ('app_state', 'staking', 'validators', None): 'validator',
+    ('app_state', 'staking', 'delegations', None): 'delegation',
+    ('app_state', 'staking', 'unbonding_delegations', None): 'unbonding_delegation',
+    ('app_state', 'distribution', 'validator_accumulated_commissions', None): 'commission',
+    ('app_state', 'distribution', 'validator_historical_rewards', None): 'historical_rewards',
+    ('app_state', 'distribution', 'validator_current_rewards', None): 'current_rewards',
+    ('app_state', 'distribution', 'delegator_starting_infos', None): 'starting_info',
+    ('app_state', 'distribution', 'validator_slash_events', None): 'slash_event'
+}
+
+
+def amount_of(coins, denom):
+    for coin in coins or []:
+        if coin['denom'] == denom:
+            return Decimal(coin['amount'])
+    return Decimal(0)
+
+
+class StateExport:
+    """Address-indexed view of an exported state, read in a single pass.
+
+    The accessors return data shaped like the matching LCD responses, so an
+    account can be reported from the export exactly as it is from the LCD."""
+
+    def __init__(self, source, denom):
+        self.denom = denom
+        self.chain_id = None
+        self.balances = {}
+        self.delegations = {}
+        self.unbonding_delegations = {}
+        self.commissions = {}
+        # operator -> (tokens, current period, current rewards)
+        self.validators = {}
+        # (operator, period) -> cumulative reward ratio
+        self.ratios = {}
+        # (delegator, operator) -> starting info
+        self.starting_infos = {}
+        # operator -> [(height, period, fraction)]
+        self.slash_events = {}
+
+        tokens = {}
+        current = {}
+        with open_genesis(source) as f:
+            for kind, value in read_document(JsonStream(f), EXPORT_PATHS):
+                if kind == 'chain_id':
+                    self.chain_id = value
+                elif kind == 'account':
+                    self.balances[value['address']] = value['coins'] or []
+                elif kind == 'validator':
+                    tokens[value['operator_address']] = Decimal(value['tokens'])
+                elif kind == 'delegation':
+                    self.delegations.setdefault(value['delegator_address'], []).append(value)
+                elif kind == 'unbonding_delegation':
+                    self.unbonding_delegations.setdefault(value['delegator_address'], []).append(value)
+                elif kind == 'commission':
+                    self.commissions[value['validator_address']] = value['accumulated'] or []
+                elif kind == 'historical_rewards':
+                    ratio = amount_of(value['rewards']['cumulative_reward_ratio'], denom)
+                    self.ratios[(value['validator_address'], int(value['period']))] = ratio
+                elif kind == 'current_rewards':
+                    rewards = value['rewards']
+                    current[value['validator_address']] = (int(rewards['period']), amount_of(rewards['rewards'], denom))
+                elif kind == 'starting_info':
+                    self.starting_infos[(value['delegator_address'], value['validator_address'])] = value['starting_info']
+                elif kind == 'slash_event':
+                    event = value['event']
+                    self.slash_events.setdefault(value['validator_address'], []).append(
+                        (int(value['height']), int(event['validator_period']), Decimal(event['fraction']))
+                    )
+
+        for operator, token_amount in tokens.items():
+            period, rewards = current.get(operator, (1, Decimal(0)))
+            self.validators[operator] = (token_amount, period, rewards)
+        for events in self.slash_events.values():
+            events.sort()
+
+    def delegators(self):
+        return set(self.delegations) | set(self.unbonding_delegations)
+
+    def balance(self, address):
+        return self.balances.get(address, [])
+
+    def commission(self, operator):
+        if operator not in self.commissions: return {}
+        return {'val_commission': self.commissions[operator]}
+
+    def rewards(self, address):
+        """Pending rewards over all of an account's delegations, the same
+        way the distribution module works them out when withdrawing."""
+        total = sum(
+            (self.__delegation_rewards(address, delegation['validator_address'])
+             for delegation in self.delegations.get(address, [])),
+            Decimal(0)
+        )
+        return [{'denom': self.denom, 'amount': str(total)}]
+
+    def __delegation_rewards(self, delegator, operator):
+        info = self.starting_infos.get((delegator, operator))
+        if info is None or operator not in self.validators:
+            return Decimal(0)
+
+        tokens, period, current_rewards = self.validators[operator]
+        # the ratio the validator's current period would end with now
+        ending_ratio = self.ratios.get((operator, period - 1), Decimal(0))
+        if tokens > 0:
+            ending_ratio += current_rewards / tokens
+
+        starting_period = int(info['previous_period'])
+        starting_height = int(info['height'])
+        stake = Decimal(info['stake'])
+        rewards = Decimal(0)
+
+        # slashes since the delegation started split its rewards into
+        # periods, each with the stake remaining at the time
+        for height, slash_period, fraction in self.slash_events.get(operator, []):
+            # from the height the delegation started, inclusive, as the SDK iterates them
+            if height >= starting_height and slash_period > starting_period:
+                rewards += self.__between(operator, starting_period, slash_period, stake)
+                stake *= 1 - fraction
+                starting_period = slash_period
+
+        difference = ending_ratio - self.ratios.get((operator, starting_period), Decimal(0))
+        return rewards + difference * stake
+
+    def __between(self, operator, starting_period, ending_period, stake):
+        difference = self.ratios.get((operator, ending_period), Decimal(0)) - \
+                     self.ratios.get((operator, starting_period), Decimal(0))
+        return difference * stake
+
+
+if __name__ == '__main__':
+    # parse command line arguments
+    parser = ArgumentParser(description="Print the pending rewards and commission of every account in an exported state, as they would be reported")
+    parser.add_argument('export', help="path to the exported state")
+    parser.add_argument('--denom', default='uatom', help="the denomination of balances/shares/etc")
+    parser.add_argument('--expected', help="path to a JSON file of the expected values by address, e.g. fixtures/state-export-expected.json; exits with 1 on any difference")
+    args = parser.parse_args()
+
+
+    export = StateExport(args.export, args.denom)
+    accounts = {}
+    for address in sorted(set(export.balances) | export.delegators()):
+        # the same truncation to whole base units as calculate_earnings.py
+        commission = export.commission(bech32.convert(address, 'cosmosvaloper')).get('val_commission')
+        accounts[address] = {
+            'pending_rewards': int(Decimal(export.rewards(address)[0]['amount'])),
+            'pending_commission': int(amount_of(commission, args.denom))
+        }
+    print(json.dumps(accounts, indent=2))
+
+    if args.expected:
+        with open(args.expected) as f:
+            expected = json.load(f)
+        differences = [address for address in sorted(set(expected) | set(accounts)) if expected.get(address) != accounts.get(address)]
+        for address in differences:
+            print(f"{address}: expected {expected.get(address)}, got {accounts.get(address)}")
+        if len(differences) > 0:
+            exit(1)
+        print("All as expected")
@@ -0,0 +1,88 @@
+import datetime
+
+from re import sub
+
+from lru import LruCache
+
+
+EPOCH = datetime.datetime(1970, 1, 1)
+EPOCH_ORDINAL = EPOCH.toordinal()
+
+
+def parse_timestamp(timestamp):
+    """Seconds since the epoch of a UTC timestamp such as
+    2019-12-11T16:00:00Z, dropping any fraction of a second."""
+    if len(timestamp) >= 20 and timestamp[4] == '-' and timestamp[10] == 'T' and timestamp[-1] == 'Z':
+        days = datetime.date(int(timestamp[0:4]), int(timestamp[5:7]), int(timestamp[8:10])).toordinal() - EPOCH_ORDINAL
+        return days * 86400 + int(timestamp[11:13]) * 3600 + int(timestamp[14:16]) * 60 + int(timestamp[17:19])
+    return to_epoch(datetime.datetime.strptime(sub(r'\.\d+Z$', "Z", timestamp), '%Y-%m-%dT%H:%M:%SZ'))
+
+
+def to_epoch(time):
+    return (time - EPOCH) // datetime.timedelta(seconds=1)
+
+
+def to_datetime(seconds):
+    return EPOCH + datetime.timedelta(seconds=seconds)
+
+
+class Tx:
+    """The parts of a transaction that move `denom`: its MsgSends and fee.
+    A failed transaction moves nothing but its fee."""
+    __slots__ = ('txhash', 'height', 'time', 'amount', 'fee', 'sends')
+
+    def __init__(self, data, denom):
+        self.txhash = data['txhash']
+        self.height = int(data['height'])
+        self.time = parse_timestamp(data['timestamp'])
+        self.amount = 0
+        self.fee = 0
+        # (message index, sender, recipient, amount) of each MsgSend
+        self.sends = ()
+
+        for amount in data['tx']['value']['fee']['amount'] or []:
+            if amount['denom'] == denom:
+                self.fee = int(amount['amount'])
+                break
+
+        success = data['logs'][0]['success']
+        sends = []
+        for (i, msg) in enumerate(data['tx']['value']['msg']):
+            # other message types can be ignored
+            if msg['type'] != 'cosmos-sdk/MsgSend': continue
+
+            value = msg['value']
+            amount = 0
+            # a failed send still has a row, with no amount, for its fee
+            for coin in value['amount'] if success else []:
+                if coin['denom'] == denom:
+                    amount += int(coin['amount'])
+            sends.append((i, value['from_address'], value['to_address'], amount))
+            self.amount += amount
+        self.sends = tuple(sends)
+
+    def rows(self):
+        """Rows for the `transactions` table, one per MsgSend; the fee
+        goes with the first."""
+        timestamp = to_datetime(self.time)
+        return [
+            (self.txhash, i, self.height, timestamp, sender, recipient, amount, self.fee if n == 0 else 0)
+            for (n, (i, sender, recipient, amount)) in enumerate(self.sends)
+        ]
+
+
+class TxCache(LruCache):
+    """Parsed transactions by txhash, shared by every thread."""
+
+    def __init__(self, denom, size=100000):
+        super().__init__(size)
+        self.denom = denom
+
+    def parse(self, data):
+        tx = self.get(data['txhash'])
+        if tx is None:
+            # parsed outside the lock; two threads may both parse a tx,
+            # which is harmless
+            tx = Tx(data, self.denom)
+            self.put(data['txhash'], tx)
+        return tx